@@ -9,23 +9,65 @@ walk thru a list of stat generating scripts
 """
 
 import os, sys
+import re
+import imp
+import bisect
 import json
+import fcntl
 import shutil
 import logging
 import tempfile
+import multiprocessing
 import subprocess
 
 from domains import Domains, Domain
+from snapshots import SnapshotStore, ProcessedLog
+from statstore import StatStore, Rollup, useStatStore, statsDBFile, addDelta, dateNeighbours
+from domainindex import getRedis
+from workqueue import openQueue
 
 # import pprint
 # pp = pprint.PrettyPrinter(indent=4)
 
 log = logging.getLogger('cruncher')
 
-def saveResults(domain, script, resultFile):
+def loadResults(resultFile):
+    results = {}
+    # results are assumed to be in the following format:
+    # { "20141004T164138": {"h-card": 1}, 
+    #   "20141001T072243": {"h-card": 1}, 
+    #   "20140930T073527": {"h-card": 1}, 
+    #   "20140926T072253": {"h-card": 1}
+    # }
+    if os.path.exists(resultFile):
+        with open(resultFile, 'r') as h:
+            results = json.load(h)
+    return results
+
+def saveResults(cfg, domain, scriptResults):
+    """Merge the results of each script, a dict of script -> results,
+    into the domain's stats file, or append them to the sqlite stats
+    store if that is configured, and update the daily rollup
+    """
+    if useStatStore(cfg):
+        store = StatStore(statsDBFile(cfg))
+        try:
+            deltas = store.append(domain, scriptResults)
+        finally:
+            store.close()
+    else:
+        deltas = saveStatsFile(cfg, domain, scriptResults)
+
+    rollup = Rollup(statsDBFile(cfg))
+    try:
+        rollup.add(deltas)
+    finally:
+        rollup.close()
+
+def saveStatsFile(cfg, domain, scriptResults):
     statsFile = os.path.join(cfg['domainPath'], domain, 'stats_%s.json' % domain)
     stats     = {}
-    results   = {}
+    deltas    = {}
 
     # stats are assumed to be in the following format:
     # { "20141004": { "count_hcards.py": { "h-card": 1 }}, 
@@ -37,116 +79,310 @@ def saveResults(domain, script, resultFile):
         with open(statsFile, 'r') as h:
             stats = json.load(h)
 
-    # results are assumed to be in the following format:
-    # { "20141004T164138": {"h-card": 1}, 
-    #   "20141001T072243": {"h-card": 1}, 
-    #   "20140930T073527": {"h-card": 1}, 
-    #   "20140926T072253": {"h-card": 1}
-    # }
-    if os.path.exists(resultFile):
-        with open(resultFile, 'r') as h:
-            results = json.load(h)
-
-        for key in results.keys():
+    dates = sorted(d for d in stats if d != 'stats')
+    for script in scriptResults:
+        results = scriptResults[script]
+        for key in sorted(results.keys()):
             resultDate = key.split('T')[0]
             if resultDate not in stats:
                 stats[resultDate] = {}
+                bisect.insort(dates, resultDate)
+            previous = stats[resultDate].get(script, {})
+            for metric in set(previous) | set(results[key]):
+                before, nextDate = dateNeighbours(stats, dates, resultDate, script, metric)
+                # a metric missing from a result carries the earlier value
+                addDelta(deltas, resultDate, metric, previous.get(metric, before),
+                         results[key].get(metric, before), nextDate)
             stats[resultDate][script] = results[key] 
 
-        with open(statsFile, 'w') as h:
-            h.write(json.dumps(stats))
-
-def process(cfg, scripts, pendingData):
-    log.info('calling %d scripts for %d domains' % (len(scripts), len(pendingData)))
-    for domain in pendingData.keys():
-        processed = []
-        for f in pendingData[domain]:
-            processed.append(f)
-        if len(processed) > 0:
-            for script in scripts:
-                scriptFile = os.path.join(cfg['dataPath'], 'scripts', script)
-                try:
-                    tempDir    = tempfile.mkdtemp(prefix='cruncher')
-                    resultFile = os.path.join(tempDir, '%s_results.json' % script)
-                    dataFile   = os.path.join(tempDir, '%s_files.json'   % script)
-
-                    # for f in os.listdir(tempDir):
-                    #     os.remove(os.path.join(tempDir, f))
-                    # if os.path.exists(resultFile):
-                    #     os.path.rmfile(resultFile)
-                    with open(dataFile, 'w') as h:
-                        h.write(json.dumps(pendingData[domain]))
-                    for f in pendingData[domain]:
-                        shutil.copyfile(os.path.join(cfg['domainPath'], domain, f), os.path.join(tempDir, f))
-                    log.info('%s %s %s %s %s' % (scriptFile, domain, tempDir, dataFile, resultFile))
-                    try:
-                        subprocess.call([scriptFile, domain, tempDir, dataFile, resultFile])
-                    except:
-                        log.exception('%s' % scriptFile)
-                    saveResults(domain, script, resultFile)
-                finally:
-                    for f in os.listdir(tempDir):
-                        s = os.path.join(tempDir, f)
-                        try:
-                            os.remove(s)
-                        except:
-                            log.exception('%s -- error removing temporary file [%s]' % (scriptFile, s))
-                    try:
-                        os.rmdir(tempDir)
-                    except:
-                        log.exception('%s -- error removing temporary directory [%s]' % (scriptFile, tempDir))
-
-            saveSeenData(domain, processed)
-
-def saveSeenData(domain, processed):
-    seenFilename = os.path.join(cfg['domainPath'], domain, 'processed.json')
-    if os.path.exists(seenFilename):
-        with open(seenFilename, 'r') as h:
+    with open(statsFile, 'w') as h:
+        h.write(json.dumps(stats))
+    return deltas
+
+def runPlugins(domain, plugins, store, entries, pending):
+    """Read each pending snapshot once and hand it to every plugin.
+    Returns a dict of script -> { ts: metrics }
+    """
+    scriptResults = {}
+    for script in plugins:
+        scriptResults[script] = {}
+    for f in pending:
+        ts   = f.split('_', 1)[0]
+        data = store.read(f, entries)
+        for script in plugins:
             try:
-                seenData = json.load(h)
+                scriptResults[script][ts] = plugins[script].count(domain, f, data)
             except:
-                seenData = []
+                log.exception('%s -- error counting [%s]' % (script, f))
+    return scriptResults
+
+def stageSnapshots(cfg, store, entries, pending):
+    """Create one staging dir per domain holding every pending snapshot
+    for the legacy scripts to read.
+
+    In the default 'link' staging mode snapshots that exist as full
+    files are hardlinked rather than copied and scripts must treat the
+    staging dir as read-only. 'copy' restores the previous behaviour.
+    Set stagingPath to a dir on the same filesystem as domainPath so
+    that hardlinks can be used instead of symlinks.
+    """
+    link        = cfg.get('staging', 'link') == 'link'
+    stagingPath = cfg.get('stagingPath')
+    if stagingPath is not None and not os.path.isdir(stagingPath):
+        try:
+            os.makedirs(stagingPath)
+        except OSError:
+            pass  # made by another worker
+    stageDir = tempfile.mkdtemp(prefix='cruncher', dir=stagingPath)
+    for f in pending:
+        store.export(f, os.path.join(stageDir, f), entries, link=link)
+    return stageDir
+
+def runScript(cfg, domain, script, stageDir, pending):
+    """Run a legacy stats script as a subprocess using the
+    domain workdir datajson resultjson protocol
+    """
+    scriptFile = os.path.join(cfg['dataPath'], 'scripts', script)
+    resultFile = os.path.join(stageDir, '%s_results.json' % script)
+    dataFile   = os.path.join(stageDir, '%s_files.json'   % script)
+
+    with open(dataFile, 'w') as h:
+        h.write(json.dumps(pending))
+    log.info('%s %s %s %s %s' % (scriptFile, domain, stageDir, dataFile, resultFile))
+    try:
+        subprocess.call([scriptFile, domain, stageDir, dataFile, resultFile])
+    except:
+        log.exception('%s' % scriptFile)
+    return loadResults(resultFile)
+
+def processDomain(cfg, domain, pending, plugins, legacy):
+    processed = []
+    for f in pending:
+        processed.append(f)
+    if len(processed) > 0:
+        store         = SnapshotStore(domain, os.path.join(cfg['domainPath'], domain))
+        entries       = store.entries()
+        scriptResults = runPlugins(domain, plugins, store, entries, processed)
+        if len(legacy) > 0:
+            stageDir = stageSnapshots(cfg, store, entries, processed)
+            try:
+                for script in legacy:
+                    scriptResults[script] = runScript(cfg, domain, script, stageDir, processed)
+            finally:
+                try:
+                    shutil.rmtree(stageDir)
+                except:
+                    log.exception('%s -- error removing staging directory [%s]' % (domain, stageDir))
+        saveResults(cfg, domain, scriptResults)
+        saveSeenData(cfg, domain, processed)
+    return len(processed)
+
+# per-process state for pool workers, plugin modules can't be pickled
+# so each worker imports its own copy
+_worker = {}
+
+def initWorker(cfg, scripts):
+    _worker['cfg']     = cfg
+    _worker['plugins'] = loadPlugins(cfg, scripts)
+    _worker['legacy']  = [script for script in scripts if script not in _worker['plugins']]
+
+def crunchDomain(item):
+    domain, pending = item
+    try:
+        return domain, processDomain(_worker['cfg'], domain, pending, _worker['plugins'], _worker['legacy'])
+    except:
+        log.exception('%s: error crunching' % domain)
+        return domain, None
+
+def process(cfg, scripts, pendingData, workers=1):
+    """Run the stats scripts over each domain's pending snapshots.
+
+    With workers > 1 the domains are sharded across a process pool;
+    each domain is only ever handled by one worker so its stats and
+    processed files are never written concurrently.
+
+    Returns the list of domains that failed to crunch.
+    """
+    failed = []
+    if workers > 1:
+        log.info('calling %d scripts for %d domains using %d workers' % (len(scripts), len(pendingData), workers))
+        pool = multiprocessing.Pool(workers, initializer=initWorker, initargs=(cfg, scripts))
+        try:
+            for domain, n in pool.imap_unordered(crunchDomain, pendingData.items()):
+                if n is None:
+                    failed.append(domain)
+                else:
+                    log.info('%s: %d files crunched' % (domain, n))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
     else:
-        seenData = []
+        initWorker(cfg, scripts)
+        log.info('calling %d plugins and %d scripts for %d domains' % (len(_worker['plugins']), len(_worker['legacy']), len(pendingData)))
+        for domain, n in map(crunchDomain, pendingData.items()):
+            if n is None:
+                failed.append(domain)
+    return failed
+
+def processQueue(cfg, domains, scripts, queue, index):
+    """Crunch the domains this process is able to claim from the queue's
+    current run. The process that starts the run fills it with every
+    domain that has pending snapshots and saves the pending index.
+
+    Each domain is added to the changed list as soon as it is crunched
+    so an interrupted run loses nothing summarize needs to see.
+    """
+    def getKeys():
+        pendingData = getPendingData(cfg, domains, index)
+        saveIndex(cfg, index)
+        return [key for key in pendingData if len(pendingData[key]) > 0]
+
+    queue.start(getKeys)
+    plugins = loadPlugins(cfg, scripts)
+    legacy  = [script for script in scripts if script not in plugins]
+    failed  = []
+    while True:
+        key = queue.claim()
+        if key is None:
+            break
+        try:
+            if key in domains:
+                domain = domains[key]
+            else:
+                domain = Domain(key, cfg['domainPath'])
+            seen    = set(getSeenData(domain))
+            pending = [f for f in domain.snapshots().names() if f not in seen]
+            if processDomain(cfg, key, pending, plugins, legacy) > 0:
+                saveChanged(cfg, [key])
+        except:
+            log.exception('%s: error crunching' % key)
+            failed.append(key)
+        queue.complete(key)
+    queue.finish()
+    if len(failed) > 0:
+        dropFromIndex(cfg, failed)
+
+def saveSeenData(cfg, domain, processed):
     log.info('%d files added to processed list for %s' % (len(processed), domain))
-    seenData += processed
-    with open(seenFilename, 'w+') as h:
-        h.write(json.dumps(seenData))
+    ProcessedLog(os.path.join(cfg['domainPath'], domain)).append(processed)
 
 def getSeenData(domain):
-    seenFilename = os.path.join(domain.domainPath, 'processed.json')
-    if os.path.exists(seenFilename):
-        with open(seenFilename, 'r') as h:
+    return ProcessedLog(domain.domainPath).read()
+
+def saveChanged(cfg, changed):
+    """Append the domains whose stats were updated to the changed list
+    that summarize.py folds into the global summary
+    """
+    with open(os.path.join(cfg['dataPath'], 'changed.log'), 'a') as h:
+        for domain in changed:
+            h.write('%s\n' % domain)
+
+def loadIndex(cfg):
+    """Load the pending index, a dict of domain -> snapshot store
+    fingerprint as of the last completed crunch
+    """
+    indexFile = os.path.join(cfg['dataPath'], 'pending_index.json')
+    index     = {}
+    if os.path.exists(indexFile):
+        with open(indexFile, 'r') as h:
             try:
-                seenData = json.load(h)
+                index = json.load(h)
             except:
-                seenData = []
-    else:
-        seenData = []
-    return seenData
-
-def getPendingData(cfg, domains):
+                index = {}
+    return index
+
+def saveIndex(cfg, index):
+    indexFile = os.path.join(cfg['dataPath'], 'pending_index.json')
+    tmpFile   = '%s.tmp' % indexFile
+    with open(tmpFile, 'w') as h:
+        h.write(json.dumps(index))
+    os.rename(tmpFile, indexFile)
+
+def dropFromIndex(cfg, keys):
+    """Remove domains from the saved pending index so the next run
+    looks at them again. The index is re-read under a lock as other
+    queue workers may be doing the same.
+    """
+    indexFile = os.path.join(cfg['dataPath'], 'pending_index.json')
+    with open('%s.lock' % indexFile, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = loadIndex(cfg)
+        for key in keys:
+            index.pop(key, None)
+        saveIndex(cfg, index)
+
+def getPendingData(cfg, domains, index=None):
+    """Return a dict of domain -> list of snapshots not yet processed.
+
+    If an index is given, domains whose snapshot store fingerprint has
+    not changed since the last run are skipped without being listed,
+    and the index is updated with the fingerprints seen now.
+    """
     log.info('searching domains for new files')
     pending = {}
+    skipped = 0
     for key in domains:
-        domain       = domains[key]
-        domainFile   = '%s.json' % key
-        seen         = getSeenData(domain)
-        pending[key] = []
-        for f in os.listdir(domain.domainPath):
-            if f != domainFile and os.path.isfile(os.path.join(domain.domainPath, f)) and not f.startswith('stats_') and not f.startswith('processed'):
-                if f not in seen:
-                    pending[key].append(f)
+        domain = domains[key]
+        store  = domain.snapshots()
+        state  = store.state()
+        if index is not None:
+            if index.get(key) == state:
+                skipped += 1
+                continue
+            index[key] = state
+        seen         = set(getSeenData(domain))
+        pending[key] = [f for f in store.names() if f not in seen]
+    if skipped > 0:
+        log.info('%d unchanged domains skipped' % skipped)
     return pending
 
 def getScripts(cfg):
     scripts    = []
     scriptPath = os.path.join(cfg['dataPath'], 'scripts')
     for f in os.listdir(scriptPath):
-        if os.path.isfile(os.path.join(scriptPath, f)):
+        if os.path.isfile(os.path.join(scriptPath, f)) and not f.endswith(('.pyc', '.pyo')):
             scripts.append(f)
     return scripts
 
+_pluginMarker = re.compile(r'^PLUGIN_API\s*=', re.MULTILINE)
+
+def isPlugin(scriptFile):
+    """A script is run in-process if it is python and declares the
+    module level PLUGIN_API marker. This is checked from the source so
+    that legacy scripts, which run as soon as they are imported, are
+    never imported.
+    """
+    if scriptFile.endswith('.py'):
+        with open(scriptFile, 'r') as h:
+            return _pluginMarker.search(h.read()) is not None
+    return False
+
+def loadPlugins(cfg, scripts):
+    """Import every plugin script, returning a dict of script -> module.
+
+    A plugin module provides
+
+        PLUGIN_API = 1
+
+        def count(domain, name, data):
+            return { 'metric': value }
+
+    where data is the parsed snapshot and the returned dict is
+    the script's result for that snapshot.
+    """
+    plugins = {}
+    for script in scripts:
+        scriptFile = os.path.join(cfg['dataPath'], 'scripts', script)
+        if isPlugin(scriptFile):
+            try:
+                plugins[script] = imp.load_source('indiestats_%s' % script.replace('.', '_'), scriptFile)
+            except:
+                log.exception('%s -- unable to load plugin, running as a script' % scriptFile)
+    return plugins
+
 def initLogging(logger, logpath=None, echo=False):
     logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
 
@@ -196,9 +432,14 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config',  default='./indie-stats.cfg')
     parser.add_argument('--echo',    default=True,  action='store_true')
+    parser.add_argument('--workers', default=1,     type=int)
+    parser.add_argument('--compact', default=False, action='store_true', help='fold each processed.log into processed.json')
+    parser.add_argument('--queue',   default=False, action='store_true', help='share the crunch with other processes thru the redis work queue')
 
     args = parser.parse_args()
     cfg  = loadConfig(args.config)
+    if args.queue and 'redis' not in cfg:
+        parser.error('--queue needs a redis config block')
 
     initLogging(log, cfg['dataPath'], args.echo)
 
@@ -207,7 +448,22 @@ if __name__ == '__main__':
     domains = Domains(cfg['dataPath'], cfg['domainPath'], cfg['domains'])
     log.info('%d domains loaded from datastore' % len(domains))
 
-    pendingData = getPendingData(cfg, domains)
-    scripts     = getScripts(cfg)
+    index   = loadIndex(cfg)
+    scripts = getScripts(cfg)
+
+    if args.queue:
+        # each queue worker is its own process, start more of them
+        # rather than using --workers
+        processQueue(cfg, domains, scripts, openQueue(cfg, getRedis(cfg['redis']), 'crunch'), index)
+    else:
+        pendingData = getPendingData(cfg, domains, index)
+
+        failed = process(cfg, scripts, pendingData, args.workers)
+        for domain in failed:
+            index.pop(domain, None)
+        saveIndex(cfg, index)
+        saveChanged(cfg, [domain for domain in pendingData if len(pendingData[domain]) > 0 and domain not in failed])
 
-    process(cfg, scripts, pendingData)
+    if args.compact:
+        for key in domains:
+            ProcessedLog(domains[key].domainPath).compact()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Redis index of the tracked domains used to page thru and
+filter the domain list without loading any domain files.
+"""
+
+import time
+import redis
+
+
+# sorted set of every domain name, all with score 0 so that it can
+# be paged thru in name order with ZRANGEBYLEX
+listKey  = 'domains-index'
+entryKey = 'domain-%s'
+
+# set once a rebuild has added every domain, single stores
+# create the sorted set without it being complete
+readyKey = 'domains-index-ready'
+
+def getRedis(options):
+    """Return a StrictRedis for the 'redis' block of a batch job config"""
+    return redis.StrictRedis(host=options.get('host', '127.0.0.1'),
+                             port=options.get('port', 6379),
+                             db=options.get('db', 0))
+
+def encodeEntry(entry):
+    result = {}
+    for key in entry:
+        value = entry[key]
+        if isinstance(value, bool):
+            value = int(value)
+        elif value is None:
+            value = ''
+        result[key] = value
+    return result
+
+def decodeEntry(data):
+    result = {}
+    for key in data:
+        value = data[key]
+        if key in ('excluded', 'claimed'):
+            value = value == '1'
+        elif key in ('status', 'interval'):
+            value = int(value) if value.isdigit() else None
+        elif value == '':
+            value = None
+        result[key] = value
+    return result
+
+def isTrue(value):
+    return value.lower() in ('1', 'true', 'yes')
+
+def matches(entry, filters):
+    """filters holds the raw query args: status, excluded, claimed and
+    polled_since (an ISO timestamp or date prefix)
+    """
+    if 'status' in filters and str(entry['status']) != filters['status']:
+        return False
+    for key in ('excluded', 'claimed'):
+        if key in filters and entry[key] != isTrue(filters[key]):
+            return False
+    if 'polled_since' in filters and (entry['polled'] is None or entry['polled'] < filters['polled_since']):
+        return False
+    return True
+
+class RedisDomainIndex(object):
+    """Keeps a hash of each domain's index entry plus a sorted set of
+    domain names in Redis. An instance can be added to
+    domains.storeListeners so every Domain.store() updates it.
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __call__(self, domain):
+        self.update(domain)
+
+    def update(self, domain, pipe=None):
+        p = pipe if pipe is not None else self.db.pipeline()
+        p.hmset(entryKey % domain.domain, encodeEntry(domain.indexEntry()))
+        p.execute_command('ZADD', listKey, 0, domain.domain)
+        if pipe is None:
+            p.execute()
+
+    def exists(self):
+        """True once the index has been fully built"""
+        return self.db.exists(readyKey)
+
+    def rebuild(self, domains):
+        pipe = self.db.pipeline(transaction=False)
+        for n, key in enumerate(domains):
+            self.update(domains[key], pipe)
+            if n % 1000 == 999:
+                pipe.execute()
+        pipe.set(readyKey, time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))
+        pipe.execute()
+
+    def page(self, cursor=None, limit=100, filters=None, maxScan=5000):
+        """Return (entries, next cursor) for up to limit domains after
+        cursor that match filters. The cursor is None at the end.
+
+        Filtering reads each entry, so at most maxScan names are read
+        per call. A page cut short by that holds fewer than limit
+        entries and its cursor is the last name read.
+        """
+        if filters is None:
+            filters = {}
+        if cursor:
+            start = '(%s' % cursor
+        else:
+            start = '-'
+        result  = []
+        scanned = 0
+        while True:
+            names = self.db.zrangebylex(listKey, start, '+', start=0, num=min(max(limit, 100), maxScan - scanned))
+            if len(names) == 0:
+                return result, None
+            pipe = self.db.pipeline(transaction=False)
+            for name in names:
+                pipe.hgetall(entryKey % name)
+            for name, data in zip(names, pipe.execute()):
+                entry = decodeEntry(data)
+                entry['domain'] = name
+                if matches(entry, filters):
+                    result.append(entry)
+                    if len(result) == limit:
+                        return result, name
+            scanned += len(names)
+            if scanned >= maxScan:
+                return result, names[-1]
+            start = '(%s' % names[-1]
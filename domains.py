@@ -10,10 +10,14 @@ Walk thru a list of resources to extract possible IndieWeb domains from.
 import os, sys
 import time
 import json
+import fcntl
+import logging
 import requests
+import fetcher
 
 from urlparse import urlparse, ParseResult
 from mf2py.parser import Parser
+from snapshots import SnapshotStore, ProcessedLog
 
 try:
     from collections import OrderedDict
@@ -22,10 +26,92 @@ except ImportError:
     from ordereddict import OrderedDict
 
 
+log = logging.getLogger('domains')
+
+# callables run with each Domain after it is stored, used to keep
+# external indexes such as domainindex.RedisDomainIndex up to date
+storeListeners = []
+
+def addStoreListener(listener):
+    storeListeners.append(listener)
+
+# sets each refreshed Domain's next poll, see schedule.Scheduler.
+# Without one every domain is always due.
+scheduler = None
+
+def setScheduler(value):
+    global scheduler
+    scheduler = value
+
+# mf2cache.ParseCache used to skip the parser for a page it has
+# already parsed
+parseCache = None
+
+def setParseCache(value):
+    global parseCache
+    parseCache = value
+
+def indexFilename(dataPath, domainFile):
+    """Return the path of the domain index"""
+    return os.path.abspath(os.path.expanduser(os.path.join(dataPath, domainFile)))
+
+def writeIndex(indexFile, data):
+    tmpFile = '%s.tmp' % indexFile
+    with open(tmpFile, 'w') as h:
+        h.write(json.dumps(data, indent=2, ensure_ascii=False, encoding='utf8'))
+    os.rename(tmpFile, indexFile)
+
+def mergeIndex(indexFile, entries):
+    """Replace the given domain index entries in the stored index,
+    which is re-read under a lock, leaving every other entry as it is
+    """
+    with open('%s.lock' % indexFile, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        current = OrderedDict()
+        if os.path.exists(indexFile):
+            with open(indexFile, 'r') as h:
+                try:
+                    for item in json.load(h):
+                        current[item['domain']] = item
+                except:
+                    log.exception('unable to read %s, rewriting it' % indexFile)
+        for entry in entries:
+            current[entry['domain']] = entry
+        writeIndex(indexFile, current.values())
+
+def parseMF2(html, url):
+    """Return the mf2 parse of html, from the parse cache if it has it"""
+    if parseCache is None:
+        return Parser(doc=html, url=url).to_dict()
+    key    = parseCache.key(html, url)
+    result = parseCache.get(key)
+    if result is None:
+        result = Parser(doc=html, url=url).to_dict()
+        parseCache.put(key, result)
+    return result
+
+# the fields kept for every domain in the domain index, everything
+# else is only read from the domain file when first needed
+indexKeys = ('domain', 'url', 'status', 'polled', 'excluded', 'claimed', 'due', 'interval')
+
+# the fields the API may return for a domain and the default selection
+apiKeys        = ('domain', 'url', 'status', 'polled', 'excluded', 'claimed', 'due', 'interval', 'headers', 'html', 'mf2', 'history')
+apiDefaultKeys = ('domain', 'url', 'status', 'polled', 'excluded', 'claimed')
+
+def domainFilename(domainPath, domain):
+    """Return the path of the domain file for domain"""
+    domain = domain.lower()
+    return os.path.join(os.path.abspath(os.path.expanduser(domainPath)), domain, '%s.json' % domain)
+
 class Domain(object):
     """An Indieweb Domain"""
 
-    def __init__(self, domain, domainPath):
+    # a large crawl holds a Domain for every tracked site, keep them compact
+    __slots__ = ('domainRoot', 'domain', 'url', 'domainPath', 'domainFile',
+                 'ts', 'polled', 'status', 'excluded', 'claimed', 'found', 'modified', 'due', 'interval',
+                 '_loaded', '_html', '_mf2', '_headers', '_history')
+
+    def __init__(self, domain, domainPath, entry=None):
         self.domainRoot = os.path.abspath(os.path.expanduser(domainPath))
         self.domain     = None
         self.url        = None
@@ -37,80 +123,251 @@ class Domain(object):
         self.excluded   = False
         self.claimed    = False
         self.found      = False
-        self.html       = ''
-        self.headers    = []
-        self.history    = []
+        self.modified   = True
+        self.due        = None
+        self.interval   = None
+        self._loaded    = True
+        self._html      = ''
+        self._mf2       = None
+        self._headers   = []
+        self._history   = None
 
-        self.load(domain)
+        self.load(domain, entry)
 
-    def load(self, domain):
+    def load(self, domain, entry=None):
+        """Load the domain from its domain file or, if an entry from
+        the domain index is given, from that without touching the
+        domain file until html, mf2 or headers are asked for
+        """
         self.url        = 'http://%s' % domain
         self.domain     = domain.lower()
         self.domainPath = os.path.join(self.domainRoot, self.domain)
-        self.domainFile = os.path.join(self.domainPath, '%s.json' % self.domain)
+        self.domainFile = domainFilename(self.domainRoot, self.domain)
 
-        if os.path.exists(self.domainFile):
+        if entry is not None:
+            for key in indexKeys:
+                if key in entry:
+                    setattr(self, key, entry[key])
+            if self.polled is not None:
+                self.ts = time.strptime(self.polled, '%Y-%m-%dT%H:%M:%SZ')
+            self._loaded  = False
+            self.found    = True
+            self.modified = False
+        elif os.path.exists(self.domainFile):
             with open(self.domainFile, 'r') as h:
                 try:
                     self.fromDict(json.load(h))
 
                     if self.polled is not None:
                         self.ts = time.strptime(self.polled, '%Y-%m-%dT%H:%M:%SZ')
-                    self.found = True
+                    # the stored mf2 is the parse of the stored html
+                    self.found    = True
+                    self.modified = False
                 except:
                     self.found = False
 
-        processedFile = os.path.join(self.domainPath, 'processed.json')
-        if os.path.exists(processedFile):
-            with open(processedFile, 'r') as h:
-                try:
-                    self.history = json.load(h)
-                except:
-                    self.history = []
-
-    def asDict(self):
-        return { 'domain':   self.domain,
-                 'url':      self.url,
-                 'html':     self.html,
-                 'headers':  dict(self.headers),
-                 'status':   self.status,
-                 'polled':   self.polled,
-                 'history':  self.history,
-                 'excluded': self.excluded,
-                 'claimed':  self.claimed,
-               }
+    def loadDetails(self):
+        """Read the fields not held in the domain index. excluded and
+        claimed are read again as well, the owner sets them in the
+        domain file and the index copy may be older.
+        """
+        if not self._loaded:
+            self._loaded = True
+            if os.path.exists(self.domainFile):
+                with open(self.domainFile, 'r') as h:
+                    try:
+                        data = json.load(h)
+                    except:
+                        data = {}
+                for key in ('html', 'mf2', 'headers', 'excluded', 'claimed'):
+                    if key in data:
+                        setattr(self, key, data[key])
+
+    def release(self):
+        """Drop the html, mf2, headers and history held in memory, they
+        will be read back from the domain file if needed again
+        """
+        self._html    = ''
+        self._mf2     = None
+        self._headers = []
+        self._history = None
+        self._loaded  = not os.path.exists(self.domainFile)
+
+    @property
+    def html(self):
+        self.loadDetails()
+        return self._html
+
+    @html.setter
+    def html(self, value):
+        self.loadDetails()
+        self._html = value
+
+    @property
+    def mf2(self):
+        self.loadDetails()
+        return self._mf2
+
+    @mf2.setter
+    def mf2(self, value):
+        self.loadDetails()
+        self._mf2 = value
+
+    @property
+    def headers(self):
+        self.loadDetails()
+        return self._headers
+
+    @headers.setter
+    def headers(self, value):
+        self.loadDetails()
+        self._headers = value
+
+    @property
+    def history(self):
+        """The list of processed snapshots, only read when first asked for"""
+        if self._history is None:
+            self._history = ProcessedLog(self.domainPath).read()
+        return self._history
+
+    @history.setter
+    def history(self, value):
+        self._history = value
+
+    def asDict(self, history=True):
+        result = { 'domain':   self.domain,
+                   'url':      self.url,
+                   'html':     self.html,
+                   'headers':  dict(self.headers),
+                   'status':   self.status,
+                   'polled':   self.polled,
+                   'excluded': self.excluded,
+                   'claimed':  self.claimed,
+                   'due':      self.due,
+                   'interval': self.interval,
+                 }
+        if history:
+            result['history'] = self.history
+        return result
+
+    def apiDict(self, fields=None):
+        """Return the API projection of the domain, limited to fields
+        (default apiDefaultKeys) so html, mf2 and history are only
+        included when asked for
+        """
+        if not fields:
+            fields = apiDefaultKeys
+        result = {}
+        for key in fields:
+            if key == 'headers':
+                result[key] = dict(self.headers)
+            elif key in apiKeys:
+                result[key] = getattr(self, key)
+        return result
+
+    def indexEntry(self):
+        """Return the compact entry kept for this domain in the domain index"""
+        result = {}
+        for key in indexKeys:
+            result[key] = getattr(self, key)
+        return result
 
     def fromDict(self, data):
-        for key in ('domain', 'url', 'html', 'headers', 'status', 'polled', 'history', 'excluded', 'claimed'):
+        # history is not read back, it always comes from the processed log
+        for key in ('domain', 'url', 'html', 'mf2', 'headers', 'status', 'polled', 'excluded', 'claimed', 'due', 'interval'):
             if key in data:
                 setattr(self, key, data[key])
 
-    def refresh(self):
+    def header(self, name):
+        """Case-insensitive lookup of a stored response header"""
+        name = name.lower()
+        for key, value in dict(self.headers).items():
+            if key.lower() == name:
+                return value
+        return None
+
+    def conditionalHeaders(self):
+        """Return the If-None-Match/If-Modified-Since request headers
+        for the last good poll, if the server gave us validators
+        """
+        result = {}
+        if self.status == requests.codes.ok and self.mf2 is not None and len(self.html) > 0:
+            etag         = self.header('etag')
+            lastModified = self.header('last-modified')
+            if etag is not None:
+                result['If-None-Match'] = etag
+            if lastModified is not None:
+                result['If-Modified-Since'] = lastModified
+        return result
+
+    def refresh(self, timeout=None, session=None):
+        """Fetch the domain's url and store the result.
+
+        timeout is passed thru to requests and can be either a single
+        value or a (connect, read) tuple. The shared pooled session
+        from fetcher is used unless one is given. The body is streamed
+        and given up on, with one of fetcher's statuses, if it isn't
+        html or breaks the max_body or deadline limits.
+
+        If a scheduler is set the domain's next poll is worked out
+        from whether the page or status changed.
+        """
+        if session is None:
+            session = fetcher.getSession()
+        # pick up an exclusion made since the index was written
+        self.loadDetails()
         if not self.excluded:
             self.ts     = time.gmtime()
             self.polled = time.strftime('%Y-%m-%dT%H:%M:%SZ', self.ts)
+            started     = time.time()
             try:
-                r = requests.get(self.url, verify=False)
-                if r.status_code == requests.codes.ok:
-                    if 'charset' in r.headers.get('content-type', ''):
-                        self.html = r.text
+                r = session.get(self.url, verify=False, timeout=timeout, headers=self.conditionalHeaders(), stream=True)
+                try:
+                    if r.status_code == requests.codes.not_modified:
+                        # unchanged since the last poll: keep the previous html, mf2
+                        # and status, only picking up any refreshed validators
+                        self.modified = False
+                        changed       = False
+                        headers       = dict((k, v) for k, v in dict(self.headers).items() if k not in r.headers)
+                        headers.update(r.headers)
+                        self.headers  = headers
                     else:
-                        r.encoding = 'utf8'
-                        self.html = r.text
-                self.headers = r.headers
-                self.status  = r.status_code
+                        self.modified = True
+                        previous      = (self.status, self.html)
+                        self.headers  = r.headers
+                        self.status   = r.status_code
+                        if r.status_code == requests.codes.ok:
+                            try:
+                                self.html = fetcher.readPage(r, fetcher.getOptions(), started)
+                            except fetcher.FetchLimit as e:
+                                # the previous html is kept, as for any other failed poll
+                                log.info('%s: %s' % (self.domain, e))
+                                self.modified = False
+                                self.status   = e.status
+                        # a first poll has nothing to have changed from
+                        changed = previous[0] is not None and (self.status, self.html) != previous
+                finally:
+                    r.close()
             except:
-                self.status = 500
+                self.modified = True
+                self.status   = 500
+                changed       = False
+
+            if scheduler is not None:
+                scheduler.update(self, changed)
 
         return self.store()
 
     def store(self):
-        data = self.asDict()
+        # history lives in the processed log, it isn't repeated per poll
+        data = self.asDict(history=False)
         if not self.excluded:
-            try:
-                data['mf2'] = Parser(doc=self.html, url=self.url).to_dict()
-            except:
-                data['mf2'] = {}
+            if self.modified or self.mf2 is None:
+                try:
+                    self.mf2 = parseMF2(self.html, self.url)
+                except:
+                    self.mf2 = {}
+            data['mf2'] = self.mf2
         if not os.path.exists(self.domainPath):
             os.mkdir(self.domainPath)
 
@@ -125,11 +382,17 @@ class Domain(object):
         with open(self.domainFile, 'w') as h:
             h.write(sData.encode('utf8'))
         if self.ts is not None:
-            statFile = os.path.join(self.domainPath, '%s_%s.json' % (time.strftime('%Y%m%dT%H%M%S', self.ts), self.domain))
-            with open(statFile, 'w') as h:
-                h.write(sData.encode('utf8'))
+            self.snapshots().add(time.strftime('%Y%m%dT%H%M%S', self.ts), data)
+        for listener in storeListeners:
+            try:
+                listener(self)
+            except:
+                log.exception('%s: store listener failed' % self.domain)
         return data
 
+    def snapshots(self):
+        return SnapshotStore(self.domain, self.domainPath)
+
 class Domains(OrderedDict):
     """A collection of Indieweb Domains"""
 
@@ -137,7 +400,7 @@ class Domains(OrderedDict):
         super(Domains, self).__init__()
         self.dataPath   = dataPath
         self.domainPath = domainPath
-        self.domainFile = os.path.abspath(os.path.expanduser(os.path.join(self.dataPath, domainFile)))
+        self.domainFile = indexFilename(self.dataPath, domainFile)
 
         if not os.path.exists(self.domainPath):
             os.mkdir(self.domainPath)
@@ -151,29 +414,36 @@ class Domains(OrderedDict):
                     data = json.load(h)
                 except:
                     data = []
-            # assumes a structure of
-            # [ { "domain":  "bear.im",
-            #     "url":     "https://bear.im",
-            #     "polled":  "2014-09-14T05:31:48Z",
-            #     "status":  200,
-            #     "history": [ 200, 200, 200, 200 ]
+            # the domain index, assumes a structure of
+            # [ { "domain":   "bear.im",
+            #     "url":      "https://bear.im",
+            #     "polled":   "2014-09-14T05:31:48Z",
+            #     "status":   200,
+            #     "excluded": false,
+            #     "claimed":  true
             #    }
             # ]
             for item in data:
-                if 'domain' in item:
-                    domain = Domain(item['url'], self.domainPath)
-                    if domain.found:
-                        self[item['domain']] = domain
+                if 'domain' in item and os.path.isdir(os.path.join(self.domainPath, item['domain'])):
+                    self[item['domain']] = Domain(item['domain'], self.domainPath, item)
 
+        # domains added since the index was last stored
         for f in os.listdir(self.domainPath):
             if f not in self:
                 domain = Domain(f, self.domainPath)
                 if domain.found:
+                    domain.release()
                     self[domain.domain] = domain
 
-    def store(self):
-        data = []
-        for key in self.keys():
-            data.append(self[key].asDict())        
-        with open(self.domainFile, 'w') as h:
-            h.write(json.dumps(data, indent=2, ensure_ascii=False, encoding='utf8'))
+    def store(self, keys=None):
+        """Write the domain index. If keys is given only those domains'
+        entries are updated in the stored index, so processes that each
+        handled part of a run don't overwrite each other's entries with
+        what they loaded at start.
+        """
+        if keys is None:
+            with open('%s.lock' % self.domainFile, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                writeIndex(self.domainFile, [self[key].indexEntry() for key in self.keys()])
+        else:
+            mergeIndex(self.domainFile, [self[key].indexEntry() for key in keys if key in self])
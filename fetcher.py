@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Shared, pooled HTTP session used by the crawler.
+"""
+
+import time
+import socket
+import threading
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+_session = None
+_options = None
+_lock    = threading.Lock()
+
+# statuses recorded for a page that wasn't read, kept out of the
+# range real servers use so they are never mistaken for one
+notHTMLStatus   = 596
+truncatedStatus = 597
+abortedStatus   = 598
+
+chunkSize = 8192
+
+class FetchLimit(Exception):
+    """The page was not read because it broke one of the fetch limits,
+    status is the one to record for it
+    """
+    def __init__(self, status, message):
+        super(FetchLimit, self).__init__(message)
+        self.status = status
+
+def sessionOptions(cfg=None):
+    """Return the pool and retry settings, using any values found
+    in the 'http' config block
+    """
+    options = { 'pool_connections': 100,
+                'pool_maxsize':     16,
+                'retries':          2,
+                'backoff':          0.5,
+                'retry_status':     [ 502, 503, 504 ],
+                'max_body':         2 * 1024 * 1024,
+                'deadline':         60,
+                'content_types':    [ 'text/html', 'application/xhtml+xml' ],
+              }
+    if cfg is not None and 'http' in cfg:
+        options.update(cfg['http'])
+    return options
+
+def buildSession(options):
+    """Build a requests.Session whose adapters keep connections
+    alive across requests and across redirect hops.
+
+    Once the retries run out the last response is returned, not
+    raised, so a site's own 503 is what gets recorded.
+
+    pool_connections is the number of per-host pools kept around,
+    pool_maxsize is the number of connections kept per host and
+    should be at least the number of refresh workers.
+    """
+    retry   = Retry(total=options['retries'],
+                    backoff_factor=options['backoff'],
+                    status_forcelist=options['retry_status'],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=options['pool_connections'],
+                          pool_maxsize=options['pool_maxsize'],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://',  adapter)
+    session.mount('https://', adapter)
+    return session
+
+def configure(cfg=None):
+    """(Re)build the shared session from the given configuration"""
+    global _session, _options
+    with _lock:
+        _options = sessionOptions(cfg)
+        _session = buildSession(_options)
+    return _session
+
+def getOptions():
+    """Return the options the shared session was configured with"""
+    global _options
+    with _lock:
+        if _options is None:
+            _options = sessionOptions()
+        return _options
+
+def isHTML(headers, contentTypes):
+    """True if the response is one of contentTypes. A response without
+    a content-type is given the benefit of the doubt.
+    """
+    contentType = headers.get('content-type', '').split(';')[0].strip().lower()
+    return len(contentType) == 0 or contentType in contentTypes
+
+def responseSocket(r):
+    """Return the socket a streamed response is being read from, or None.
+
+    httplib drops the connection's socket for a response that closes
+    the connection after it (HTTP/1.0, Connection: close) so the
+    socket is then only found thru the response's own file.
+    """
+    try:
+        sock = r.raw._connection.sock
+        if sock is not None:
+            return sock
+    except AttributeError:
+        pass
+    try:
+        # the httplib response under urllib3, before it is released
+        return r.raw._fp.fp._sock
+    except AttributeError:
+        return None
+
+def abortRead(r, expired):
+    """Shut down the response's socket, which wakes a read blocked on
+    it, unlike closing it
+    """
+    expired.set()
+    sock = responseSocket(r)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, AttributeError):
+            pass
+
+def readPage(r, options, started):
+    """Read the body of a response made with stream=True and return it
+    decoded. FetchLimit is raised, and the connection dropped, if the
+    response isn't html, is larger than max_body bytes or is still
+    being read deadline seconds after started.
+    """
+    if not isHTML(r.headers, options['content_types']):
+        raise FetchLimit(notHTMLStatus, 'content-type %s' % r.headers.get('content-type'))
+    length = r.headers.get('content-length', '')
+    if length.isdigit() and int(length) > options['max_body']:
+        raise FetchLimit(truncatedStatus, 'content-length %s' % length)
+
+    deadline  = started + options['deadline']
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise FetchLimit(abortedStatus, 'not read after %d seconds' % options['deadline'])
+
+    # a read blocks until a whole chunk arrives, which a slow enough
+    # server can drag out far past the deadline, so the timer shuts the
+    # socket down from under it
+    expired = threading.Event()
+    timer   = threading.Timer(remaining, abortRead, args=(r, expired))
+    timer.daemon = True
+    timer.start()
+    chunks = []
+    size   = 0
+    try:
+        for chunk in r.iter_content(chunkSize):
+            size += len(chunk)
+            if size > options['max_body']:
+                raise FetchLimit(truncatedStatus, 'more than %d bytes' % options['max_body'])
+            chunks.append(chunk)
+    except FetchLimit:
+        raise
+    except Exception:
+        if not expired.is_set():
+            raise
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise FetchLimit(abortedStatus, 'not read after %d seconds' % options['deadline'])
+
+    # without a charset requests would assume latin-1 for text/html
+    encoding = 'utf8'
+    if 'charset' in r.headers.get('content-type', '') and r.encoding:
+        encoding = r.encoding
+    try:
+        return ''.join(chunks).decode(encoding, 'replace')
+    except LookupError:
+        return ''.join(chunks).decode('utf8', 'replace')
+
+def getSession():
+    """Return the shared session, building it with the default
+    options if configure() has not been called
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = buildSession(sessionOptions())
+        return _session
@@ -9,11 +9,19 @@ Walk thru a list of resources to extract possible IndieWeb domains from.
 
 import os, sys
 import json
+import time
+import Queue
 import logging
+import threading
 
 import requests
+import fetcher
 from urlparse import urlparse
-from domains import Domains, Domain
+from domains import Domains, Domain, addStoreListener, setScheduler, setParseCache
+from domainindex import RedisDomainIndex, getRedis
+from workqueue import openQueue
+from schedule import Scheduler, scheduleOptions
+from mf2cache import openParseCache
 from mf2py.parser import Parser
 
 # import pprint
@@ -21,10 +29,10 @@ from mf2py.parser import Parser
 
 log = logging.getLogger('gather')
 
-def checkURL(url):
+def checkURL(url, timeout=None):
     result = None
     try:
-        r = requests.head(url, allow_redirects=True)
+        r = fetcher.getSession().head(url, allow_redirects=True, timeout=timeout)
         if r.status_code == requests.codes.ok:
             result = r.url
     except:
@@ -32,8 +40,10 @@ def checkURL(url):
     return result
 
 def gather(cfg, domains):
-    n = 0
-    r = requests.get(cfg['IRCPeople'], verify=False)
+    n       = 0
+    options = refreshOptions(cfg)
+    timeout = (options['connect_timeout'], options['read_timeout'])
+    r       = fetcher.getSession().get(cfg['IRCPeople'], verify=False, timeout=timeout)
     log.info('IRCPeople request returned %s' % r.status_code)
     if r.status_code == requests.codes.ok:
         if 'charset' in r.headers.get('content-type', ''):
@@ -46,7 +56,7 @@ def gather(cfg, domains):
                 if 'children' in item:
                     for child in item['children']:
                         if 'properties' in child:
-                            s = checkURL(child['properties']['url'][0])
+                            s = checkURL(child['properties']['url'][0], timeout)
                             if s is not None:
                                 url = urlparse(s)
                                 if len(url.netloc) > 0:
@@ -84,8 +94,66 @@ def gather(cfg, domains):
     log.info('%d new domains added' % n)
     return n
 
-def refresh(cfg, domains):
-    log.info('refreshing domains')
+class HostLimiter(object):
+    """Hand out a bounded semaphore per host so that no single
+    host sees more than limit concurrent requests
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock  = threading.Lock()
+        self.hosts = {}
+
+    def get(self, url):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.limit)
+            return self.hosts[host]
+
+def refreshOptions(cfg):
+    """Return the concurrency and timeout settings for refresh,
+    using any values found in the 'refresh' config block
+    """
+    options = { 'workers':         16,
+                'per_host':        2,
+                'connect_timeout': 10,
+                'read_timeout':    30,
+              }
+    if 'refresh' in cfg:
+        options.update(cfg['refresh'])
+    return options
+
+def refreshWorker(work, limiter, timeout, done=None, queue=None):
+    """Refresh domains taken from work until a (None, None) item is
+    seen, passing each finished domain's key on to done if given and
+    completing its lease if it came from a WorkQueue
+    """
+    while True:
+        key, domain = work.get()
+        try:
+            if domain is None:
+                return
+            hostLock = limiter.get(domain.url)
+            with hostLock:
+                result = domain.refresh(timeout=timeout)
+            log.info('%s: %s' % (domain.domain, result['status']))
+            # the page is stored, don't keep it around for the rest of the crawl
+            result = None
+            domain.release()
+        except:
+            log.exception('%s: error finalizing' % key)
+        finally:
+            work.task_done()
+        if queue is not None:
+            try:
+                queue.complete(key)
+            except:
+                log.exception('%s: unable to complete lease' % key)
+        if done is not None:
+            done.put(key)
+
+def addListedDomains(cfg, domains):
+    """Add any domain in domain_list.txt that isn't already known"""
     domainList = os.path.join(cfg['domainPath'], 'domain_list.txt')
     if os.path.exists(domainList):
         with open(domainList, 'r') as h:
@@ -95,15 +163,65 @@ def refresh(cfg, domains):
                     o = Domain(domain, cfg['domainPath'])
                     if o.domain not in domains:
                         log.info('%s not found in domain list' % o.domain)
-                        domains[o.domain] = domain
+                        domains[o.domain] = o
 
-    for key in domains:
-        try:
-            domain = domains[key]
-            result = domain.refresh()
-            log.info('%s: %s' % (domain.domain, result['status']))
-        except:
-            log.error('%s: error finalizing' % key)
+def dueKeys(domains, scheduler=None):
+    """Return the keys of the domains the scheduler says are due,
+    every domain if there is no scheduler
+    """
+    if scheduler is None:
+        return domains.keys()
+    now    = time.time()
+    result = [key for key in domains if scheduler.isDue(domains[key], now)]
+    log.info('%d of %d domains are due' % (len(result), len(domains)))
+    return result
+
+def refresh(cfg, domains, workers=None, queue=None, scheduler=None):
+    """Refresh every domain that is due, or with a WorkQueue only the
+    domains this process is able to claim from the queue's current run.
+    Returns the keys of the domains refreshed.
+    """
+    log.info('refreshing domains')
+    addListedDomains(cfg, domains)
+
+    options = refreshOptions(cfg)
+    if workers is not None:
+        options['workers'] = workers
+    timeout = (options['connect_timeout'], options['read_timeout'])
+    limiter = HostLimiter(options['per_host'])
+    work    = Queue.Queue(maxsize=options['workers'] * 2)
+    threads = []
+
+    log.info('using %d workers, %d per host' % (options['workers'], options['per_host']))
+    for i in range(options['workers']):
+        t = threading.Thread(target=refreshWorker, args=(work, limiter, timeout, None, queue))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    if queue is None:
+        keys = dueKeys(domains, scheduler)
+        for key in keys:
+            work.put((key, domains[key]))
+    else:
+        keys = []
+        queue.start(lambda: dueKeys(domains, scheduler))
+        while True:
+            key = queue.claim()
+            if key is None:
+                break
+            if key not in domains:
+                # added to the run by another process
+                domains[key] = Domain(key, cfg['domainPath'])
+            keys.append(key)
+            work.put((key, domains[key]))
+    for t in threads:
+        work.put((None, None))
+    for t in threads:
+        t.join()
+    if queue is not None:
+        queue.finish()
+    return keys
 
 def initLogging(logger, logpath=None, echo=False):
     logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
@@ -156,11 +274,22 @@ if __name__ == '__main__':
     parser.add_argument('--echo',    default=True,  action='store_true')
     parser.add_argument('--seed'  ,  default=False, action='store_true')
     parser.add_argument('--refresh', default=False, action='store_true')
+    parser.add_argument('--workers', default=None,  type=int)
+    parser.add_argument('--queue',   default=False, action='store_true', help='share the refresh with other processes thru the redis work queue')
+    parser.add_argument('--all',     default=False, action='store_true', help='refresh every domain, not only the ones due')
 
     args = parser.parse_args()
     cfg  = loadConfig(args.config)
+    if args.queue and 'redis' not in cfg:
+        parser.error('--queue needs a redis config block')
 
     initLogging(log, cfg['dataPath'], args.echo)
+    fetcher.configure(cfg)
+    if 'redis' in cfg:
+        addStoreListener(RedisDomainIndex(getRedis(cfg['redis'])))
+    scheduler = Scheduler(scheduleOptions(cfg))
+    setScheduler(scheduler)
+    setParseCache(openParseCache(cfg))
 
     log.info('starting')
 
@@ -170,7 +299,17 @@ if __name__ == '__main__':
     if args.seed:
         gather(cfg, domains)
 
+    if args.queue:
+        queue = openQueue(cfg, getRedis(cfg['redis']), 'refresh')
+    else:
+        queue = None
+
+    keys = None
     if args.refresh:
-        refresh(cfg, domains)
+        keys = refresh(cfg, domains, args.workers, queue, None if args.all else scheduler)
 
-    domains.store()
+    if queue is None or keys is None:
+        domains.store()
+    else:
+        # other processes store the domains they refreshed
+        domains.store(keys)
@@ -13,8 +13,10 @@ import json
 import time
 import uuid
 import urllib
+import hashlib
 import logging
 import datetime
+import threading
 
 import ninka
 import redis
@@ -23,7 +25,9 @@ import requests
 from bearlib.config import Config
 from bearlib.tools import baseDomain
 from urlparse import urlparse, ParseResult
-from flask import Flask, request, redirect, render_template, session, flash, jsonify
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from flask import Flask, request, redirect, render_template, session, flash
 
 from flask.ext.wtf import Form
 from wtforms import TextField, HiddenField, BooleanField
@@ -32,7 +36,11 @@ from flask_restful import reqparse, abort, Resource, Api
 
 sys.path.append(os.path.dirname(__file__))
 
-from domains import Domain, Domains
+from domains import Domain, Domains, domainFilename, indexFilename, mergeIndex, addStoreListener, setParseCache
+from domainindex import RedisDomainIndex
+from snapshots import ProcessedLog
+from mf2cache import openParseCache
+from statstore import StatStore, Rollup, useStatStore, statsDBFile
 
 
 class LoginForm(Form):
@@ -73,15 +81,30 @@ parser.add_argument('domain')
 
 class DomainList(Resource):
     def get(self):
+        """Page thru the tracked domains in name order.
+
+        ?cursor= is the last domain of the previous page, ?limit= the
+        page size (max 1000) and status, excluded, claimed and
+        polled_since filter the entries returned. A filtered page can
+        be short, only the cursor being null marks the end.
+        """
         app.logger.info('apiDomainList')
-        l = db.get('cache-domain-list')
-        if l is None:
-            domainList = Domains(cfg.dataPath, cfg.domainPath, cfg.domains)
-            l = domainList.keys()
-            db.set('cache-domain-list', json.dumps(l))
-        else:
-            l = json.loads(l)
-        return l
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+        except ValueError:
+            limit = 100
+        filters = {}
+        for key in ('status', 'excluded', 'claimed', 'polled_since'):
+            if key in request.args:
+                filters[key] = request.args.get(key)
+        index = RedisDomainIndex(db)
+        if not index.exists():
+            # the index is normally kept current by Domain.store(), this
+            # only happens until it has been built once and only reads
+            # domains.json
+            index.rebuild(Domains(cfg.dataPath, cfg.domainPath, cfg.domains))
+        entries, cursor = index.page(request.args.get('cursor'), limit, filters)
+        return { "domains": entries, "cursor": cursor }
 
     # def post(self):
     #     args = parser.parse_args()
@@ -105,35 +128,191 @@ class DomainList(Resource):
     #     else:
     #         return { "domain": domain, "result": "Domain is already being tracked" }, 200
 
+def parseFields(value):
+    """Turn a ?fields=a,b,c argument into a sorted list of field names"""
+    if value is None:
+        return []
+    return sorted(set(f.strip() for f in value.split(',') if len(f.strip()) > 0))
+
+def domainCacheKey(domain, fields):
+    """The cache key is versioned by the domain file's mtime so any
+    store() of the domain, from the web app or the batch jobs, moves
+    readers to a new key. History comes from the processed log instead,
+    which the cruncher appends to without a store(), so the mtime and
+    size of processed.log and processed.json are part of the version.
+    Returns None if the domain isn't tracked.
+    """
+    filename = domainFilename(cfg.domainPath, domain)
+    try:
+        version = ['%d' % (os.stat(filename).st_mtime * 1000)]
+    except OSError:
+        return None
+    processed = ProcessedLog(os.path.dirname(filename))
+    for f in (processed.logFile, processed.summaryFile):
+        try:
+            s = os.stat(f)
+            version.append('%d.%d' % (s.st_mtime * 1000, s.st_size))
+        except OSError:
+            version.append('0')
+    return 'cache-%s-%s-%s' % (domain.lower(), '-'.join(version), ','.join(fields))
+
+def loadDomainInfo(domain, fields):
+    o = Domain(domain, cfg.domainPath)
+    if not o.found:
+        return None
+    return o.apiDict(fields)
+
+def cacheDomainInfo(r, key, d):
+    """SETEX d under key using r, a Redis connection or pipeline,
+    unless it is over the size limit
+    """
+    s = json.dumps(d)
+    if len(s) <= cfg.cache_max_bytes:
+        r.setex(key, cfg.cache_ttl, s)
+
+def getDomainInfo(domain, fields):
+    key = domainCacheKey(domain, fields)
+    if key is None:
+        return None
+    if db is not None:
+        d = db.get(key)
+        if d is not None:
+            return json.loads(d)
+    d = loadDomainInfo(domain, fields)
+    if d is not None and db is not None:
+        cacheDomainInfo(db, key, d)
+    return d
+
+# threads used to load the domain files of batch cache misses
+_loadPool = None
+
+def getLoadPool():
+    global _loadPool
+    if _loadPool is None:
+        _loadPool = ThreadPool(8)
+    return _loadPool
+
+def getDomainInfos(domainList, fields):
+    """Return a dict of domain -> info (None if not tracked) using a
+    single MGET for the cache hits, concurrent loads for the misses
+    and a single pipeline to cache what was loaded
+    """
+    result = {}
+    keys   = {}
+    for domain in domainList:
+        key = domainCacheKey(domain, fields)
+        if key is None:
+            result[domain] = None
+        else:
+            keys[domain] = key
+    names  = keys.keys()
+    misses = names
+    if db is not None and len(names) > 0:
+        misses = []
+        for domain, d in zip(names, db.mget([keys[domain] for domain in names])):
+            if d is None:
+                misses.append(domain)
+            else:
+                result[domain] = json.loads(d)
+    if len(misses) > 0:
+        loaded = getLoadPool().map(lambda domain: loadDomainInfo(domain, fields), misses)
+        pipe   = db.pipeline(transaction=False) if db is not None else None
+        for domain, d in zip(misses, loaded):
+            result[domain] = d
+            if d is not None and pipe is not None:
+                cacheDomainInfo(pipe, keys[domain], d)
+        if pipe is not None:
+            pipe.execute()
+    return result
+
 class DomainInfo(Resource):
     def get(self, domain):
         app.logger.info('apiDomainInfo [%s]' % domain)
-        d = db.get('cache-%s' % domain)
-        if d is None:
-            o = Domain(domain, cfg.domainPath)
-            if o.found:
-                d = o.asDict()
-                db.set('cache-%s' % domain, json.dumps(d))
-            else:
-                d = None
-        else:
-            d = json.loads(d)
+        d = getDomainInfo(domain, parseFields(request.args.get('fields')))
         if d is None:
             return { "domain": domain, "result": "Domain is not being tracked" }, 404
         else:
             return d, 200
 
+class DomainBatch(Resource):
+    maxDomains = 1000
+
+    def post(self):
+        """Info for many domains at once. Expects a JSON body of
+        { "domains": [ ... ], "fields": [ ... ] } where fields is optional
+        and works as ?fields= does for a single domain
+        """
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('domains'), list):
+            return { "result": "a JSON body with a list of domains is required" }, 400
+        domainList = [d for d in data['domains'] if isinstance(d, basestring)]
+        if len(domainList) > self.maxDomains:
+            return { "result": "at most %d domains can be requested at once" % self.maxDomains }, 400
+        fields = data.get('fields') or []
+        if isinstance(fields, basestring):
+            fields = parseFields(fields)
+        else:
+            fields = sorted(set(f for f in fields if isinstance(f, basestring)))
+        app.logger.info('apiDomainBatch [%d domains]' % len(domainList))
+        return { "domains": getDomainInfos(domainList, fields) }, 200
+
+class StatsSeries(Resource):
+    def get(self):
+        """Daily global totals for ?metric= (repeatable, default all)
+        between ?start= and ?end= (YYYYMMDD, inclusive)
+        """
+        app.logger.info('apiStatsSeries')
+        start   = request.args.get('start')
+        end     = request.args.get('end')
+        metrics = request.args.getlist('metric')
+        rollup  = Rollup(statsDBFile(cfg))
+        try:
+            series = rollup.series(metrics=metrics, start=start, end=end)
+        finally:
+            rollup.close()
+        return { "start": start, "end": end, "series": series }, 200
+
 api.add_resource(DomainList, '/api/v1/domains')
 api.add_resource(DomainInfo, '/api/v1/domains/<domain>')
+api.add_resource(DomainBatch, '/api/v1/domains:batch')
+api.add_resource(StatsSeries, '/api/v1/stats/series')
+
+
+# token -> session lookups in a single round-trip each
+_lookupSessionLua = """
+local key = redis.call('GET', KEYS[1])
+if not key then
+    return false
+end
+return {key, redis.call('HGET', key, 'token')}
+"""
+_clearSessionLua = """
+local key = redis.call('GET', KEYS[1])
+if key then
+    redis.call('DEL', key)
+end
+return redis.call('DEL', KEYS[1])
+"""
+_scripts = {}
 
+def sessionScript(name, lua):
+    if name not in _scripts:
+        _scripts[name] = db.register_script(lua)
+    return _scripts[name]
+
+def lookupSession(token):
+    """Return the login key for token if it is still that login's
+    current token, otherwise None
+    """
+    result = sessionScript('lookup', _lookupSessionLua)(keys=['token-%s' % token])
+    if result and result[1] == token:
+        return result[0]
+    return None
 
 def clearAuth():
     if 'indieauth_token' in session:
         if db is not None:
-            key = db.get('token-%s' % session['indieauth_token'])
-            if key:
-                db.delete(key)
-                db.delete('token-%s' % session['indieauth_token'])
+            sessionScript('clear', _clearSessionLua)(keys=['token-%s' % session['indieauth_token']])
     session.pop('indieauth_token', None)
     session.pop('indieauth_scope', None)
     session.pop('indieauth_id',    None)
@@ -146,11 +325,7 @@ def checkAuth():
         indieauth_id    = session['indieauth_id']
         indieauth_token = session['indieauth_token']
         if db is not None:
-            key = db.get('token-%s' % indieauth_token)
-            if key:
-                data = db.hgetall(key)
-                if data and data['token'] == indieauth_token:
-                    authed = True
+            authed = lookupSession(indieauth_token) is not None
     return authed, indieauth_id
 
 def checkAccessToken(access_token):
@@ -213,15 +388,18 @@ def handleLogin():
                 if db is not None:
                     key  = 'login-%s' % me
                     data = db.hgetall(key)
+                    pipe = db.pipeline()
                     if data and 'token' in data: # clear any existing auth data
-                        db.delete('token-%s' % data['token'])
-                        db.hdel(key, 'token')
-                    db.hset(key, 'auth_url',     ParseResult(authURL.scheme, authURL.netloc, authURL.path, '', '', '').geturl())
-                    db.hset(key, 'from_uri',     form.from_uri.data)
-                    db.hset(key, 'redirect_uri', form.redirect_uri.data)
-                    db.hset(key, 'client_id',    form.client_id.data)
-                    db.hset(key, 'scope',        'post')
-                    db.expire(key, cfg.auth_timeout) # expire in N minutes unless successful
+                        pipe.delete('token-%s' % data['token'])
+                        pipe.hdel(key, 'token')
+                    pipe.hmset(key, { 'auth_url':     ParseResult(authURL.scheme, authURL.netloc, authURL.path, '', '', '').geturl(),
+                                      'from_uri':     form.from_uri.data,
+                                      'redirect_uri': form.redirect_uri.data,
+                                      'client_id':    form.client_id.data,
+                                      'scope':        'post',
+                                    })
+                    pipe.expire(key, cfg.auth_timeout) # expire in N minutes unless successful
+                    pipe.execute()
                 app.logger.info('redirecting to [%s]' % url)
                 return redirect(url)
         else:
@@ -259,11 +437,11 @@ def handleLoginSuccess():
                 from_uri = data['from_uri']
                 token    = str(uuid.uuid4())
 
-                db.hset(key, 'code',  code)
-                db.hset(key, 'token', token)
-                db.expire(key, cfg['auth_timeout'])
-                db.set('token-%s' % token, key)
-                db.expire('token-%s' % code, cfg['auth_timeout'])
+                pipe = db.pipeline()
+                pipe.hmset(key, { 'code': code, 'token': token })
+                pipe.expire(key, cfg['auth_timeout'])
+                pipe.setex('token-%s' % token, cfg['auth_timeout'], key)
+                pipe.execute()
 
                 session['indieauth_token'] = token
                 session['indieauth_scope'] = scope
@@ -289,11 +467,7 @@ def handleAuth():
     if db is not None:
         token = request.args.get('token')
         if token is not None:
-            me = db.get('token-%s' % token)
-            if me:
-                data = db.hgetall(me)
-                if data and data['token'] == token:
-                    result = True
+            result = lookupSession(token) is not None
     if result:
         return 'valid', 200
     else:
@@ -351,8 +525,10 @@ def handleToken():
             if token is None:
                 token     = str(uuid.uuid4())
                 token_key = 'token-%s' % token
-                db.set(key, token)
-                db.set(token_key, key)
+                pipe      = db.pipeline()
+                pipe.set(key, token)
+                pipe.set(token_key, key)
+                pipe.execute()
 
             app.logger.info('  token generated for [%s] : [%s]' % (key, token))
 
@@ -409,6 +585,7 @@ def handleDomain():
 
         if not found and owner:
             domain.store()
+            mergeIndex(indexFilename(cfg.dataPath, cfg.domains), [domain.indexEntry()])
             found = True
     else:
         found = False
@@ -424,6 +601,8 @@ def handleDomain():
                 domain.excluded = form.excluded.data
                 domain.claimed  = True
                 domain.store()
+                # the batch jobs read the flags from the domain index
+                mergeIndex(indexFilename(cfg.dataPath, cfg.domains), [domain.indexEntry()])
                 return redirect('/domain')
             else:
                 flash('all fields are required')
@@ -475,6 +654,63 @@ def handleDomain():
 
         return render_template('domain-not-found.jinja', **templateContext)
 
+class CachedJSON(object):
+    def __init__(self, data, modified):
+        self.data     = data
+        self.body     = json.dumps(data)
+        self.etag     = hashlib.sha1(self.body).hexdigest()
+        self.modified = datetime.datetime.utcfromtimestamp(int(modified))
+
+class DataCache(object):
+    """Parsed and pre-serialized JSON data read from disk, keyed by the
+    file it comes from plus an optional query key and invalidated
+    whenever the file's mtime or size changes. The batch jobs only
+    rewrite these files once a day, so almost every request is a hit.
+    """
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self.entries    = OrderedDict()
+        self.lock       = threading.Lock()
+
+    def get(self, filename, loader, key=None):
+        """Return the CachedJSON for (filename, key), calling loader()
+        to build the data if it is missing or stale, or None if the
+        file doesn't exist
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        stamp = (st.st_mtime, st.st_size)
+        with self.lock:
+            entry = self.entries.pop((filename, key), None)
+            if entry is not None and entry[0] == stamp:
+                self.entries[(filename, key)] = entry
+                return entry[1]
+        cached = CachedJSON(loader(), st.st_mtime)
+        with self.lock:
+            self.entries[(filename, key)] = (stamp, cached)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return cached
+
+dataCache = DataCache()
+
+def loadJSONFile(filename):
+    def loader():
+        with open(filename, 'r') as h:
+            return json.load(h)
+    return loader
+
+def cachedResponse(cached):
+    """Serve a CachedJSON with ETag/Last-Modified, answering 304 when
+    the client already has it
+    """
+    response = app.response_class(cached.body, mimetype='application/json')
+    response.set_etag(cached.etag)
+    response.last_modified = cached.modified
+    return response.make_conditional(request)
+
 @app.route('/stats', methods=['GET'])
 def handleStats():
     app.logger.info('handleStats [%s]' % request.method)
@@ -482,20 +718,33 @@ def handleStats():
     d = request.args.get('domain')
     app.logger.info('args["domain"] %s' % d)
     if d is None:
-        with open(os.path.join(cfg['dataPath'], 'summary.json'), 'r') as h:
-            result = json.load(h)
-        return jsonify(**result)
+        summaryFile = os.path.join(cfg['dataPath'], 'summary.json')
+        return cachedResponse(dataCache.get(summaryFile, loadJSONFile(summaryFile)))
     else:
         url = urlparse(d)
         if len(url.netloc) > 0:
             domain = url.netloc
         else:
             domain = d
+        if useStatStore(cfg):
+            start   = request.args.get('start')
+            end     = request.args.get('end')
+            metrics = request.args.getlist('metric')
+            def loader():
+                store = StatStore(statsDBFile(cfg))
+                try:
+                    return store.domainStats(domain, start=start, end=end, metrics=metrics)
+                finally:
+                    store.close()
+            cached = dataCache.get(statsDBFile(cfg), loader, key=(domain, start, end, tuple(metrics)))
+            if cached is not None and len(cached.data) > 0:
+                return cachedResponse(cached)
+            else:
+                return 'unable to determine domain', 404
         statsFile = os.path.join(cfg['domainPath'], domain, 'stats_%s.json' % domain)
-        if os.path.exists(statsFile):
-            with open(statsFile, 'r') as h:
-                result = json.load(h)
-                return jsonify(**result)
+        cached    = dataCache.get(statsFile, loadJSONFile(statsFile))
+        if cached is not None:
+            return cachedResponse(cached)
         else:
             return 'unable to determine domain', 404
 
@@ -516,10 +765,10 @@ def handleIndex():
     templateContext['authed_url']    = indieauth_id
     templateContext['from_uri']      = '/'
 
-    with open(os.path.join(cfg.dataPath, 'summary.json'), 'r') as h:
-        stats = json.load(h)
-        for key in stats:
-            templateContext[key] = stats[key] 
+    summaryFile = os.path.join(cfg.dataPath, 'summary.json')
+    stats       = dataCache.get(summaryFile, loadJSONFile(summaryFile)).data
+    for key in stats:
+        templateContext[key] = stats[key] 
 
     return render_template('index.jinja', **templateContext)
 
@@ -554,16 +803,38 @@ def loadConfig(configFilename, host=None, port=None, logpath=None):
         result.paths.log = logpath
     if 'auth_timeout' not in result:
         result.auth_timeout = 300
+    if 'cache_ttl' not in result:
+        result.cache_ttl = 3600
+    if 'cache_max_bytes' not in result:
+        result.cache_max_bytes = 64 * 1024
     return result
 
 def getRedis(config):
+    """Build the Redis client from the 'redis' config block.
+
+    max_connections caps the connections each uwsgi worker may open;
+    when set, callers wait up to pool_timeout seconds for a free
+    connection instead of opening another one.
+    """
     if 'host' not in config:
         config.host = '127.0.0.1'
     if 'port' not in config:
         config.port = 6379
     if 'db' not in config:
         config.db = 0
-    return redis.StrictRedis(host=config.host, port=config.port, db=config.db)
+    if 'socket_timeout' not in config:
+        config.socket_timeout = None
+    if 'max_connections' in config:
+        if 'pool_timeout' not in config:
+            config.pool_timeout = 5
+        pool = redis.BlockingConnectionPool(host=config.host, port=config.port, db=config.db,
+                                            socket_timeout=config.socket_timeout,
+                                            max_connections=config.max_connections,
+                                            timeout=config.pool_timeout)
+    else:
+        pool = redis.ConnectionPool(host=config.host, port=config.port, db=config.db,
+                                    socket_timeout=config.socket_timeout)
+    return redis.StrictRedis(connection_pool=pool)
 
 def doStart(app, configFile, ourHost=None, ourPort=None, ourPath=None, echo=False):
     _cfg = loadConfig(configFile, host=ourHost, port=ourPort, logpath=ourPath)
@@ -573,6 +844,8 @@ def doStart(app, configFile, ourHost=None, ourPort=None, ourPath=None, echo=Fals
     initLogging(app.logger, _cfg.paths.log, echo=echo)
     if 'redis' in _cfg:
         _db = getRedis(_cfg.redis)
+        addStoreListener(RedisDomainIndex(_db))
+    setParseCache(openParseCache(_cfg))
     app.logger.info('configuration loaded from %s' % configFile)
     return _cfg, _db
 
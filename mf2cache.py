@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+On disk cache of mf2 parse results keyed by the page that was parsed.
+"""
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import threading
+
+import mf2py
+
+
+log = logging.getLogger('mf2cache')
+
+# a new parser can give a different result for the same page
+parserVersion = getattr(mf2py, '__version__', 'unknown')
+
+def parseCacheOptions(cfg):
+    """Return the cache location and size limit, using any values
+    found in the 'mf2cache' config block
+    """
+    options = { 'path':      os.path.join(cfg['dataPath'], 'mf2cache'),
+                'max_bytes': 256 * 1024 * 1024,
+              }
+    if 'mf2cache' in cfg:
+        options.update(cfg['mf2cache'])
+    return options
+
+class ParseCache(object):
+    """Parse results stored gzipped as <path>/<key[:2]>/<key>.json.gz,
+    where the key is the sha1 of the parser version, url and html.
+
+    Reading an entry touches it, and once about a tenth of max_bytes
+    has been added the least recently used entries are removed until
+    the cache is back under 90% of max_bytes. The cache can be shared
+    by any number of processes.
+    """
+    def __init__(self, path, maxBytes):
+        self.path     = path
+        self.maxBytes = maxBytes
+        self.added    = 0
+        self.lock     = threading.Lock()
+
+    def key(self, html, url):
+        if isinstance(html, unicode):
+            html = html.encode('utf8')
+        if isinstance(url, unicode):
+            url = url.encode('utf8')
+        return hashlib.sha1('%s\0%s\0%s' % (parserVersion, url, html)).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], '%s.json.gz' % key)
+
+    def get(self, key):
+        """Return the cached result for key or None"""
+        f = self.filename(key)
+        try:
+            with gzip.open(f, 'rb') as h:
+                result = json.loads(h.read())
+            os.utime(f, None)
+            return result
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, key, mf2):
+        f       = self.filename(key)
+        tmpFile = '%s.%d.%d.tmp' % (f, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+        except OSError:
+            pass  # made by another worker
+        try:
+            with gzip.open(tmpFile, 'wb') as h:
+                h.write(json.dumps(mf2))
+            os.rename(tmpFile, f)
+            size = os.path.getsize(f)
+        except (IOError, OSError):
+            log.exception('unable to cache %s' % key)
+            return
+        with self.lock:
+            self.added += size
+            trim        = self.added > self.maxBytes / 10
+            if trim:
+                self.added = 0
+        if trim:
+            self.trim()
+
+    def trim(self):
+        """Remove the least recently used entries once the cache is over max_bytes"""
+        entries = []
+        total   = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith('.json.gz'):
+                    f = os.path.join(root, name)
+                    try:
+                        s = os.stat(f)
+                    except OSError:
+                        continue
+                    entries.append((s.st_mtime, s.st_size, f))
+                    total += s.st_size
+        if total > self.maxBytes:
+            entries.sort()
+            target = self.maxBytes * 9 / 10
+            for mtime, size, f in entries:
+                if total <= target:
+                    break
+                try:
+                    os.remove(f)
+                    total -= size
+                except OSError:
+                    pass
+            log.info('mf2 cache trimmed to %d bytes' % total)
+
+def openParseCache(cfg):
+    options = parseCacheOptions(cfg)
+    return ParseCache(options['path'], options['max_bytes'])
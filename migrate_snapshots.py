@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+convert each domain's per-poll snapshot files into
+the compressed, content-addressed snapshot store and
+optionally load the stats files into the sqlite stats store
+"""
+
+import os, sys
+import json
+import logging
+
+from snapshots import SnapshotStore
+from statstore import StatStore, Rollup, statsDBFile
+
+# import pprint
+# pp = pprint.PrettyPrinter(indent=4)
+
+log = logging.getLogger('migrate_snapshots')
+
+
+def initLogging(logger, logpath=None, echo=False):
+    logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    if logpath is not None:
+        logfilename = os.path.join(logpath, 'migrate_snapshots.log')
+        logHandler  = logging.FileHandler(logfilename)
+        logHandler.setFormatter(logFormatter)
+        logger.addHandler(logHandler)
+
+    if echo:
+        echoHandler = logging.StreamHandler()
+        echoHandler.setFormatter(logFormatter)
+        logger.addHandler(echoHandler)
+
+    logger.setLevel(logging.INFO)
+
+def loadConfig(configFilename):
+    filename = os.path.abspath(os.path.expanduser(configFilename))
+    cfg      = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as h:
+            cfg = json.load(h)
+    else:
+        print('creating default configuration at %s' % filename)
+        cwd = os.getcwd()
+        cfg['dataPath']  = os.path.join(cwd, 'data')
+        cfg['datastore'] = 'files'
+        cfg['domains']   = 'domains.dat'
+        cfg['domainPath']   = os.path.join(cfg['dataPath'], 'mf2data')
+        cfg['IRCPeople'] = 'http://indiewebcamp.com/IRC-people'
+        with open(filename, 'w') as h:
+            json.dump(cfg, h, indent=2)
+
+        if not os.path.exists(cfg['dataPath']):
+            print('creating dataPath %s' % cfg['dataPath'])
+            os.mkdir(cfg['dataPath'])
+        if not os.path.exists(cfg['domainPath']):
+            print('creating domainPath %s' % cfg['domainPath'])
+            os.mkdir(cfg['domainPath'])
+
+    return cfg
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',  default='./indie-stats.cfg')
+    parser.add_argument('--echo',    default=True,  action='store_true')
+    parser.add_argument('--keep',    default=False, action='store_true', help='leave the original files in place')
+    parser.add_argument('--stats',   default=False, action='store_true', help='import stats_<domain>.json files into the stats store')
+
+    args = parser.parse_args()
+    cfg  = loadConfig(args.config)
+
+    initLogging(log, cfg['dataPath'], args.echo)
+
+    log.info('starting')
+
+    domainRoot = os.path.abspath(os.path.expanduser(cfg['domainPath']))
+    total      = 0
+    statStore  = None
+    if args.stats:
+        statStore = StatStore(statsDBFile(cfg))
+    for key in os.listdir(domainRoot):
+        domainPath = os.path.join(domainRoot, key)
+        if os.path.isdir(domainPath):
+            try:
+                n = SnapshotStore(key, domainPath).migrate(keep=args.keep)
+                if n > 0:
+                    log.info('%s: %d files converted' % (key, n))
+                total += n
+                statsFile = os.path.join(domainPath, 'stats_%s.json' % key)
+                if statStore is not None and os.path.exists(statsFile):
+                    statStore.importJson(key, statsFile)
+                    log.info('%s: stats imported' % key)
+            except:
+                log.exception('%s: error converting snapshots' % key)
+    log.info('%d files converted' % total)
+
+    if statStore is not None:
+        rollup = Rollup(statsDBFile(cfg))
+        rollup.rebuildFromStats()
+        log.info('rollup rebuilt from imported stats')
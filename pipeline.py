@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Nightly run in a single pass: each domain is fetched, stored,
+crunched and folded into the summary as it comes off the
+previous stage instead of running gather_domains, cruncher and
+summarize one after the other over the whole corpus.
+"""
+
+import os, sys
+import json
+import Queue
+import logging
+import threading
+import multiprocessing
+
+import fetcher
+from domains import Domains, addStoreListener, setScheduler, setParseCache
+from domainindex import RedisDomainIndex, getRedis
+from schedule import Scheduler, scheduleOptions
+from mf2cache import openParseCache
+from gather_domains import gather, addListedDomains, dueKeys, refreshOptions, refreshWorker, HostLimiter
+from cruncher import initWorker, crunchDomain, getScripts, getSeenData, loadIndex, saveIndex, saveChanged
+from summarize import domainContribution, foldDomain, openStatStore, loadState, saveState, \
+                      fullSummary, incrementalSummary, takeChanged, doneChanged, rollupStale, rebuildRollup
+
+# import pprint
+# pp = pprint.PrettyPrinter(indent=4)
+
+log = logging.getLogger('pipeline')
+
+def pipelineOptions(cfg):
+    """Return the crunch concurrency and queue size for the pipeline,
+    using any values found in the 'pipeline' config block
+    """
+    options = { 'crunch_workers': 1,
+                'queue_size':     64,
+              }
+    if 'pipeline' in cfg:
+        options.update(cfg['pipeline'])
+    return options
+
+def crunchStage(cfg, domains, index, crunchQueue, foldQueue, pool, inflight):
+    """Work out what each fetched domain has pending and crunch it, either
+    here or in the pool. Domains with new stats are passed on to foldQueue.
+    """
+    def finished(result):
+        domain, n = result
+        try:
+            if n is None:
+                index.pop(domain, None)
+            elif n > 0:
+                log.info('%s: %d files crunched' % (domain, n))
+                saveChanged(cfg, [domain])
+                foldQueue.put(domain)
+        finally:
+            inflight.release()
+
+    while True:
+        key = crunchQueue.get()
+        if key is None:
+            break
+        try:
+            domain = domains[key]
+            state  = domain.snapshots().state()
+            if index.get(key) == state:
+                continue
+            index[key] = state
+            seen    = set(getSeenData(domain))
+            pending = [f for f in domain.snapshots().names() if f not in seen]
+            if len(pending) == 0:
+                continue
+            inflight.acquire()
+            if pool is None:
+                finished(crunchDomain((key, pending)))
+            else:
+                pool.apply_async(crunchDomain, ((key, pending),), callback=finished)
+        except:
+            log.exception('%s: error queueing for crunch' % key)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    foldQueue.put(None)
+
+def foldStage(cfg, state, foldQueue):
+    """Fold each crunched domain into the summary state. The stats
+    store is opened here as sqlite connections can't be shared
+    between threads.
+    """
+    statStore = None
+    if state is not None:
+        statStore = openStatStore(cfg)
+    while True:
+        key = foldQueue.get()
+        if key is None:
+            break
+        if state is not None:
+            try:
+                foldDomain(state, key, domainContribution(cfg, key, statStore))
+            except:
+                log.exception('%s: error folding into summary' % key)
+    if statStore is not None:
+        statStore.close()
+
+def run(cfg, domains, scripts, state, index, workers=None, crunchWorkers=None, scheduler=None):
+    options  = refreshOptions(cfg)
+    pOptions = pipelineOptions(cfg)
+    if workers is not None:
+        options['workers'] = workers
+    if crunchWorkers is not None:
+        pOptions['crunch_workers'] = crunchWorkers
+    timeout = (options['connect_timeout'], options['read_timeout'])
+    limiter = HostLimiter(options['per_host'])
+
+    work        = Queue.Queue(maxsize=options['workers'] * 2)
+    crunchQueue = Queue.Queue(maxsize=pOptions['queue_size'])
+    foldQueue   = Queue.Queue(maxsize=pOptions['queue_size'])
+
+    # the pool has to be forked before any other thread is started
+    pool = None
+    if pOptions['crunch_workers'] > 1:
+        pool     = multiprocessing.Pool(pOptions['crunch_workers'], initializer=initWorker, initargs=(cfg, scripts))
+        inflight = threading.BoundedSemaphore(pOptions['crunch_workers'] * 2)
+    else:
+        # crunch in the stage thread with the plugins loaded here
+        initWorker(cfg, scripts)
+        inflight = threading.BoundedSemaphore(1)
+
+    log.info('using %d fetch workers, %d per host, %d crunch workers' %
+             (options['workers'], options['per_host'], pOptions['crunch_workers']))
+
+    folder = threading.Thread(target=foldStage, args=(cfg, state, foldQueue))
+    folder.daemon = True
+    folder.start()
+    cruncher = threading.Thread(target=crunchStage, args=(cfg, domains, index, crunchQueue, foldQueue, pool, inflight))
+    cruncher.daemon = True
+    cruncher.start()
+
+    fetchers = []
+    for i in range(options['workers']):
+        t = threading.Thread(target=refreshWorker, args=(work, limiter, timeout, crunchQueue))
+        t.daemon = True
+        t.start()
+        fetchers.append(t)
+
+    due = dueKeys(domains, scheduler)
+    for key in due:
+        work.put((key, domains[key]))
+    for t in fetchers:
+        work.put((None, None))
+    for t in fetchers:
+        t.join()
+
+    # domains that weren't polled can still have snapshots waiting, left
+    # by reset_pending or a failed crunch, the crunch stage skips any
+    # whose snapshot store hasn't changed since it was last crunched
+    due = set(due)
+    for key in domains:
+        if key not in due:
+            crunchQueue.put(key)
+
+    crunchQueue.put(None)
+    cruncher.join()
+    folder.join()
+
+def initLogging(logger, logpath=None, echo=False):
+    logFormatter = logging.Formatter("%(asctime)s %(levelname)-9s %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    if logpath is not None:
+        logfilename = os.path.join(logpath, 'pipeline.log')
+        logHandler  = logging.FileHandler(logfilename)
+        logHandler.setFormatter(logFormatter)
+        logger.addHandler(logHandler)
+
+    if echo:
+        echoHandler = logging.StreamHandler()
+        echoHandler.setFormatter(logFormatter)
+        logger.addHandler(echoHandler)
+
+    logger.setLevel(logging.INFO)
+
+def loadConfig(configFilename):
+    filename = os.path.abspath(os.path.expanduser(configFilename))
+    cfg      = {}
+    if os.path.exists(filename):
+        with open(filename, 'r') as h:
+            cfg = json.load(h)
+    else:
+        print('creating default configuration at %s' % filename)
+        cwd = os.getcwd()
+        cfg['dataPath']  = os.path.join(cwd, 'data')
+        cfg['datastore'] = 'files'
+        cfg['domains']   = 'domains.dat'
+        cfg['domainPath']   = os.path.join(cfg['dataPath'], 'mf2data')
+        cfg['IRCPeople'] = 'http://indiewebcamp.com/IRC-people'
+        with open(filename, 'w') as h:
+            json.dump(cfg, h, indent=2)
+
+        if not os.path.exists(cfg['dataPath']):
+            print('creating dataPath %s' % cfg['dataPath'])
+            os.mkdir(cfg['dataPath'])
+        if not os.path.exists(cfg['domainPath']):
+            print('creating domainPath %s' % cfg['domainPath'])
+            os.mkdir(cfg['domainPath'])
+
+    return cfg
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config',         default='./indie-stats.cfg')
+    parser.add_argument('--echo',           default=True,  action='store_true')
+    parser.add_argument('--seed',           default=False, action='store_true')
+    parser.add_argument('--all',            default=False, action='store_true', help='refresh every domain, not only the ones due')
+    parser.add_argument('--workers',        default=None,  type=int, help='number of fetch workers')
+    parser.add_argument('--crunch-workers', default=None,  type=int, dest='crunchWorkers', help='number of crunch processes')
+
+    args = parser.parse_args()
+    cfg  = loadConfig(args.config)
+
+    # the stage modules log thru their own loggers
+    for logger in (log, logging.getLogger('gather'), logging.getLogger('cruncher'), logging.getLogger('summarize')):
+        initLogging(logger, cfg['dataPath'], args.echo)
+    fetcher.configure(cfg)
+    if 'redis' in cfg:
+        addStoreListener(RedisDomainIndex(getRedis(cfg['redis'])))
+    scheduler = Scheduler(scheduleOptions(cfg))
+    setScheduler(scheduler)
+    setParseCache(openParseCache(cfg))
+
+    log.info('starting')
+
+    domains = Domains(cfg['dataPath'], cfg['domainPath'], cfg['domains'])
+    log.info('%d domains loaded from datastore' % len(domains))
+
+    if args.seed:
+        gather(cfg, domains)
+    addListedDomains(cfg, domains)
+
+    if rollupStale(cfg):
+        log.info('rebuilding the daily totals')
+        rebuildRollup(cfg, domains)
+
+    # pick up anything a standalone cruncher run left for summarize
+    state = loadState(cfg)
+    if state is not None:
+        state = incrementalSummary(cfg, state)
+
+    index   = loadIndex(cfg)
+    scripts = getScripts(cfg)
+
+    run(cfg, domains, scripts, state, index, args.workers, args.crunchWorkers, None if args.all else scheduler)
+
+    saveIndex(cfg, index)
+    domains.store()
+
+    # every domain in the changed list has been folded by now, it is
+    # only kept until the state is saved in case the run is interrupted
+    takeChanged(cfg)
+    if state is None:
+        state = fullSummary(cfg, domains)
+    saveState(cfg, state)
+    doneChanged(cfg)
@@ -13,6 +13,8 @@ import json
 import logging
 
 from domains import Domains, Domain
+from snapshots import ProcessedLog
+from statstore import Rollup, useStatStore, statsDBFile
 
 # import pprint
 # pp = pprint.PrettyPrinter(indent=4)
@@ -81,11 +83,23 @@ if __name__ == '__main__':
     log.info('%d domains loaded from datastore' % len(domains))
 
     for key in domains:
-        domain        = domains[key]
-        statsFile     = os.path.join(cfg['domainPath'], key, 'stats_%s.json' % key)
-        processedFile = os.path.join(cfg['domainPath'], key, 'processed.json')
+        domain    = domains[key]
+        statsFile = os.path.join(cfg['domainPath'], key, 'stats_%s.json' % key)
 
         if os.path.exists(statsFile):
             os.remove(statsFile)
-        if os.path.exists(processedFile):
-            os.remove(processedFile)
+        ProcessedLog(os.path.join(cfg['domainPath'], key)).remove()
+
+    # the daily totals were built from the stats files just removed, the
+    # re-crunch adds every value back. In the sqlite store the stats rows
+    # are kept and the re-crunch only adds what differs from them.
+    if not useStatStore(cfg) and os.path.exists(statsDBFile(cfg)):
+        rollup = Rollup(statsDBFile(cfg))
+        rollup.clear()
+        rollup.close()
+
+    # everything will be crunched again, so the summary is rebuilt in full
+    for f in ('pending_index.json', 'summary_state.json'):
+        indexFile = os.path.join(cfg['dataPath'], f)
+        if os.path.exists(indexFile):
+            os.remove(indexFile)
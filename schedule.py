@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Work out when each domain is next due to be polled.
+"""
+
+import time
+import calendar
+
+
+def scheduleOptions(cfg):
+    """Return the polling intervals, in seconds, and the factors they
+    are adjusted by, using any values found in the 'schedule' config block
+    """
+    options = { 'interval':     86400,
+                'min_interval': 86400,
+                'max_interval': 14 * 86400,
+                'max_failing':  30 * 86400,
+                'tighten':      0.5,
+                'backoff':      1.5,
+                'failing':      2.0,
+                'slack':        3600,
+              }
+    if 'schedule' in cfg:
+        options.update(cfg['schedule'])
+    return options
+
+def isFailing(status):
+    return status is None or status >= 400
+
+def toTimestamp(value):
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+def fromTimestamp(value):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value))
+
+class Scheduler(object):
+    """Sets a domain's polling interval after each poll: it is
+    tightened when the page or status changed, backed off when it
+    didn't and backed off faster for a site that keeps failing.
+
+    A domain without an interval yet gets one by replaying its poll
+    history, so existing domains start at a sensible rate.
+    """
+    def __init__(self, options):
+        self.options = options
+
+    def nextInterval(self, interval, changed, status):
+        o = self.options
+        if isFailing(status):
+            interval = min(interval * o['failing'], o['max_failing'])
+        elif changed:
+            interval = max(interval * o['tighten'], o['min_interval'])
+        else:
+            interval = min(interval * o['backoff'], o['max_interval'])
+        return int(interval)
+
+    def historyInterval(self, domain):
+        """Replay the domain's poll log, comparing each poll's content
+        hash and status with the one before it
+        """
+        interval = self.options['interval']
+        previous = None
+        for entry in domain.snapshots().entries().values():
+            current = (entry.get('status'), entry.get('object'))
+            if previous is not None:
+                interval = self.nextInterval(interval, current != previous, current[0])
+            previous = current
+        return interval
+
+    def update(self, domain, changed):
+        """Set domain.interval and domain.due for the poll just made"""
+        if domain.interval is None:
+            domain.interval = self.historyInterval(domain)
+        domain.interval = self.nextInterval(domain.interval, changed, domain.status)
+        domain.due      = fromTimestamp(toTimestamp(domain.polled) + domain.interval)
+
+    def isDue(self, domain, now=None):
+        """True if domain should be polled by a run started at now. A poll
+        due within the slack is taken now rather than skipped to the
+        following run.
+        """
+        if domain.excluded:
+            return False
+        if domain.due is None:
+            return True
+        if now is None:
+            now = time.time()
+        return toTimestamp(domain.due) <= now + self.options['slack']
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Content-addressed storage for per-poll domain snapshots.
+"""
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6 or earlier, use backport
+    from ordereddict import OrderedDict
+
+
+# the bulky parts of a snapshot that are stored once per distinct value
+payloadKeys   = ('html', 'mf2')
+compressLevel = 6
+
+def snapshotName(ts, domain):
+    return '%s_%s.json' % (ts, domain)
+
+def isLegacySnapshot(domain, filename):
+    """True if filename is an old style full snapshot file for domain"""
+    return filename.endswith('_%s.json' % domain) and not filename.startswith('stats_')
+
+def linkFile(source, target):
+    """Hardlink source to target, falling back to a symlink and
+    then to a copy when links are not possible
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        try:
+            os.symlink(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+class SnapshotStore(object):
+    """Per-domain snapshot store.
+
+    Each poll appends one line to polls.log holding the small per-poll
+    fields (status, polled, headers, ...) plus the hash of its payload.
+    The payload (html and mf2) is written once, gzip compressed, to
+    objects/<hash>.json.gz so identical pages polled day after day
+    share a single file. Uncompressed objects/<hash>.json files are
+    still read.
+
+    Snapshot files written before this store existed are still listed
+    and read as-is.
+    """
+    def __init__(self, domain, domainPath):
+        self.domain     = domain
+        self.domainPath = domainPath
+        self.objectPath = os.path.join(domainPath, 'objects')
+        self.logFile    = os.path.join(domainPath, 'polls.log')
+        self.lastKey    = None
+        self.lastObject = None
+
+    def objectFile(self, key, compressed=True):
+        if compressed:
+            return os.path.join(self.objectPath, '%s.json.gz' % key)
+        else:
+            return os.path.join(self.objectPath, '%s.json' % key)
+
+    def hasObject(self, key):
+        return os.path.exists(self.objectFile(key)) or os.path.exists(self.objectFile(key, compressed=False))
+
+    def putObject(self, payload):
+        sData = json.dumps(payload, sort_keys=True, ensure_ascii=False, encoding='utf8').encode('utf8')
+        key   = hashlib.sha1(sData).hexdigest()
+        if not self.hasObject(key):
+            self.writeObject(key, sData)
+        return key
+
+    def writeObject(self, key, sData):
+        if not os.path.exists(self.objectPath):
+            os.mkdir(self.objectPath)
+        fname   = self.objectFile(key)
+        tmpFile = '%s.tmp' % fname
+        h = gzip.open(tmpFile, 'wb', compressLevel)
+        try:
+            h.write(sData)
+        finally:
+            h.close()
+        os.rename(tmpFile, fname)
+
+    def getObject(self, key):
+        # consecutive polls of an unchanged page share an object
+        if key != self.lastKey:
+            fname = self.objectFile(key)
+            if os.path.exists(fname):
+                h = gzip.open(fname, 'rb')
+            else:
+                h = open(self.objectFile(key, compressed=False), 'r')
+            try:
+                self.lastObject = json.load(h)
+            finally:
+                h.close()
+            self.lastKey = key
+        return self.lastObject
+
+    def add(self, ts, data):
+        """Record a poll taken at ts (YYYYMMDDTHHMMSS) and return its name"""
+        name    = snapshotName(ts, self.domain)
+        payload = {}
+        entry   = { 'name': name }
+        for key in data:
+            if key in payloadKeys:
+                payload[key] = data[key]
+            else:
+                entry[key] = data[key]
+        entry['object'] = self.putObject(payload)
+        line = json.dumps(entry, ensure_ascii=False, encoding='utf8')
+        with open(self.logFile, 'a') as h:
+            h.write(line.encode('utf8'))
+            h.write('\n')
+        return name
+
+    def entries(self):
+        """Return an OrderedDict of name -> poll log entry.
+        A name polled more than once keeps its last entry.
+        """
+        result = OrderedDict()
+        if os.path.exists(self.logFile):
+            with open(self.logFile, 'r') as h:
+                for line in h:
+                    line = line.strip()
+                    if len(line) > 0:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue  # partially written line
+                        result[entry['name']] = entry
+        return result
+
+    def names(self):
+        """Return the names of every poll, legacy files included"""
+        result = []
+        if os.path.isdir(self.domainPath):
+            for f in os.listdir(self.domainPath):
+                if isLegacySnapshot(self.domain, f):
+                    result.append(f)
+        seen = set(result)
+        for name in self.entries():
+            if name not in seen:
+                result.append(name)
+        result.sort()
+        return result
+
+    def state(self):
+        """Return a cheap [dir mtime, poll log size] fingerprint that
+        changes whenever a poll is added to the store
+        """
+        try:
+            dirMtime = os.stat(self.domainPath).st_mtime
+        except OSError:
+            dirMtime = None
+        try:
+            logSize = os.stat(self.logFile).st_size
+        except OSError:
+            logSize = 0
+        return [dirMtime, logSize]
+
+    def migrate(self, keep=False):
+        """Move legacy per-poll files into the poll log and compress
+        any uncompressed objects. Returns the number of files converted.
+        """
+        n       = 0
+        entries = self.entries()
+        for name in self.names():
+            if name not in entries:
+                legacyFile = os.path.join(self.domainPath, name)
+                with open(legacyFile, 'r') as h:
+                    data = json.load(h)
+                # each legacy file repeats the processed list as of its
+                # poll, that lives in the processed log now
+                data.pop('history', None)
+                self.add(name.split('_')[0], data)
+                if not keep:
+                    os.remove(legacyFile)
+                n += 1
+        if os.path.isdir(self.objectPath):
+            for f in os.listdir(self.objectPath):
+                if f.endswith('.json'):
+                    plainFile = os.path.join(self.objectPath, f)
+                    key       = f[:-len('.json')]
+                    with open(plainFile, 'r') as h:
+                        self.writeObject(key, h.read())
+                    os.remove(plainFile)
+                    n += 1
+        return n
+
+    def read(self, name, entries=None):
+        """Return the full snapshot dict for name"""
+        if entries is None:
+            entries = self.entries()
+        if name in entries:
+            data = dict(entries[name])
+            data.update(self.getObject(data.pop('object')))
+            data.pop('name', None)
+            return data
+        with open(os.path.join(self.domainPath, name), 'r') as h:
+            return json.load(h)
+
+    def export(self, name, targetFile, entries=None, link=False):
+        """Write the full snapshot for name to targetFile in the
+        same format as the original per-poll snapshot files.
+
+        With link=True a snapshot that already exists as a full file
+        is hardlinked (or symlinked across filesystems) instead of
+        copied, so the target must be treated as read-only.
+        """
+        if entries is None:
+            entries = self.entries()
+        legacyFile = os.path.join(self.domainPath, name)
+        if name not in entries and os.path.isfile(legacyFile):
+            if link:
+                linkFile(legacyFile, targetFile)
+            else:
+                shutil.copyfile(legacyFile, targetFile)
+        else:
+            sData = json.dumps(self.read(name, entries), indent=2, ensure_ascii=False, encoding='utf8')
+            with open(targetFile, 'w') as h:
+                h.write(sData.encode('utf8'))
+
+class ProcessedLog(object):
+    """Per-domain record of which snapshots cruncher has processed.
+
+    New names are appended, one per line, to processed.log so recording
+    a run never rewrites the existing history. processed.json holds the
+    compacted list (and is what older versions wrote) and compact()
+    folds the log back into it.
+    """
+    def __init__(self, domainPath):
+        self.summaryFile = os.path.join(domainPath, 'processed.json')
+        self.logFile     = os.path.join(domainPath, 'processed.log')
+
+    def read(self):
+        """Return the list of processed names in the order processed"""
+        result = []
+        if os.path.exists(self.summaryFile):
+            with open(self.summaryFile, 'r') as h:
+                try:
+                    result = json.load(h)
+                except:
+                    result = []
+        if os.path.exists(self.logFile):
+            with open(self.logFile, 'r') as h:
+                for line in h:
+                    line = line.strip()
+                    if len(line) > 0:
+                        result.append(line)
+        return result
+
+    def append(self, names):
+        with open(self.logFile, 'a') as h:
+            for name in names:
+                h.write('%s\n' % name)
+
+    def compact(self):
+        """Fold processed.log into processed.json, dropping duplicates"""
+        if os.path.exists(self.logFile):
+            names = list(OrderedDict.fromkeys(self.read()))
+            tmpFile = '%s.tmp' % self.summaryFile
+            with open(tmpFile, 'w') as h:
+                h.write(json.dumps(names))
+            os.rename(tmpFile, self.summaryFile)
+            os.remove(self.logFile)
+
+    def remove(self):
+        for fname in (self.summaryFile, self.logFile):
+            if os.path.exists(fname):
+                os.remove(fname)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+sqlite backed store for the per-domain stats generated by cruncher.
+"""
+
+import os
+import json
+import bisect
+import sqlite3
+import itertools
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS stats (
+    domain TEXT    NOT NULL,
+    date   TEXT    NOT NULL,
+    script TEXT    NOT NULL,
+    metric TEXT    NOT NULL,
+    value  NUMERIC,
+    PRIMARY KEY (domain, date, script, metric)
+);
+CREATE INDEX IF NOT EXISTS stats_metric_date ON stats (metric, date);
+CREATE INDEX IF NOT EXISTS stats_date ON stats (date);
+CREATE INDEX IF NOT EXISTS stats_series ON stats (domain, script, metric, date);
+CREATE TABLE IF NOT EXISTS rollup (
+    metric TEXT    NOT NULL,
+    date   TEXT    NOT NULL,
+    value  NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (metric, date)
+);
+"""
+
+# a domain's value of a metric holds from its result's date until
+# its next result, the rollup keeps the change to each metric's total
+# on each date and the total as of a date is the sum of the changes
+# up to it. Version 1 kept the sum of the values found on each date,
+# which dropped every domain not polled on that date
+rollupVersion = 2
+
+def isNumber(value):
+    return isinstance(value, (int, long, float))
+
+def addDelta(deltas, date, metric, old, new, nextDate=None):
+    """Accumulate into deltas the change to the total of metric from a
+    domain's value on date going from old, the value it had in effect
+    on that date, to new. The change is undone at nextDate, the date
+    of the domain's next result for the metric if there is one.
+
+    Values that aren't numbers are ignored. A first value is always
+    recorded, even if zero, so the daily series has no gaps.
+    """
+    first = old is None
+    if old is None:
+        old = 0
+    if new is None:
+        new = 0
+    if isNumber(old) and isNumber(new) and (first or new != old):
+        deltas[(date, metric)] = deltas.get((date, metric), 0) + new - old
+        if nextDate is not None and new != old:
+            deltas[(nextDate, metric)] = deltas.get((nextDate, metric), 0) - (new - old)
+
+def addSeries(deltas, rows):
+    """Accumulate the deltas for the whole history of one domain, given
+    as rows of (script, metric, date, value) sorted in that order
+    """
+    for series, values in itertools.groupby(rows, lambda row: row[:2]):
+        old = None
+        for script, metric, date, value in values:
+            addDelta(deltas, date, metric, old, value)
+            old = value
+
+def statsDeltas(stats):
+    """Return the deltas for the whole of a stats_<domain>.json file"""
+    rows = []
+    for resultDate in stats:
+        if resultDate == 'stats':
+            continue
+        for script in stats[resultDate]:
+            for metric in stats[resultDate][script]:
+                rows.append((script, metric, resultDate, stats[resultDate][script][metric]))
+    rows.sort()
+    deltas = {}
+    addSeries(deltas, rows)
+    return deltas
+
+def dateNeighbours(stats, dates, date, script, metric):
+    """Return the domain's value of metric from the latest date before
+    date and the first date after date with a value, from a stats dict
+    of { date: { script: { metric: value }}} and its sorted dates
+    """
+    before   = None
+    nextDate = None
+    for d in reversed(dates[:bisect.bisect_left(dates, date)]):
+        if metric in stats[d].get(script, {}):
+            before = stats[d][script][metric]
+            break
+    for d in dates[bisect.bisect_right(dates, date):]:
+        if metric in stats[d].get(script, {}):
+            nextDate = d
+            break
+    return before, nextDate
+
+def useStatStore(cfg):
+    """True if the config selects the sqlite stats store over the
+    per-domain stats_<domain>.json files
+    """
+    return 'statsStore' in cfg and cfg['statsStore'] == 'sqlite'
+
+def statsDBFile(cfg):
+    if 'statsDB' in cfg:
+        return cfg['statsDB']
+    return os.path.join(cfg['dataPath'], 'stats.db')
+
+class StatStore(object):
+    """One row per domain, date, script and metric, indexed by domain
+    and by metric and date so that both a single domain's history and
+    a metric across every domain can be read without touching any
+    other rows.
+    """
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self.db     = sqlite3.connect(dbFile, timeout=60)
+        self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def append(self, domain, scriptResults):
+        """Add the results of each script, a dict of
+        script -> { "20141004T164138": { metric: value }}
+
+        Returns the change to the per-date global totals as a dict of
+        (date, metric) -> delta for Rollup.add()
+        """
+        deltas = {}
+        with self.db:
+            for script in scriptResults:
+                results = scriptResults[script]
+                for key in sorted(results.keys()):
+                    resultDate = key.split('T')[0]
+                    previous   = dict(self.db.execute('SELECT metric, value FROM stats WHERE domain = ? AND date = ? AND script = ?',
+                                                      (domain, resultDate, script)).fetchall())
+                    for metric in set(previous) | set(results[key]):
+                        before, nextDate = self.neighbours(domain, resultDate, script, metric)
+                        # a metric missing from a result carries the earlier value
+                        addDelta(deltas, resultDate, metric, previous.get(metric, before),
+                                 results[key].get(metric, before), nextDate)
+                    # a script's result for a date replaces the previous one
+                    self.db.execute('DELETE FROM stats WHERE domain = ? AND date = ? AND script = ?', (domain, resultDate, script))
+                    self.db.executemany('INSERT INTO stats VALUES (?, ?, ?, ?, ?)',
+                                        [(domain, resultDate, script, metric, results[key][metric]) for metric in results[key]])
+        return deltas
+
+    def neighbours(self, domain, date, script, metric):
+        """Return the domain's value of metric from the latest date
+        before date and the first date after date with a value
+        """
+        row = self.db.execute('SELECT value FROM stats WHERE domain = ? AND script = ? AND metric = ? AND date < ? '
+                              'ORDER BY date DESC LIMIT 1', (domain, script, metric, date)).fetchone()
+        before   = row[0] if row is not None else None
+        nextDate = self.db.execute('SELECT MIN(date) FROM stats WHERE domain = ? AND script = ? AND metric = ? AND date > ?',
+                                   (domain, script, metric, date)).fetchone()[0]
+        return before, nextDate
+
+    def dateRange(self, domain):
+        """Return the (first, last) date with stats for domain"""
+        row = self.db.execute('SELECT MIN(date), MAX(date) FROM stats WHERE domain = ?', (domain,)).fetchone()
+        return row[0], row[1]
+
+    def domainStats(self, domain, start=None, end=None, metrics=None):
+        """Return the domain's stats in the same shape as the
+        stats_<domain>.json files, { date: { script: { metric: value }}},
+        limited to the given date range and metrics
+        """
+        sql    = 'SELECT date, script, metric, value FROM stats WHERE domain = ?'
+        params = [domain]
+        if start is not None:
+            sql += ' AND date >= ?'
+            params.append(start)
+        if end is not None:
+            sql += ' AND date <= ?'
+            params.append(end)
+        if metrics:
+            sql += ' AND metric IN (%s)' % ','.join('?' * len(metrics))
+            params.extend(metrics)
+        result = {}
+        for date, script, metric, value in self.db.execute(sql, params):
+            result.setdefault(date, {}).setdefault(script, {})[metric] = value
+        return result
+
+    def totals(self, metric, start=None, end=None):
+        """Return [(date, total)] of metric summed over every domain"""
+        sql    = 'SELECT date, SUM(value) FROM stats WHERE metric = ?'
+        params = [metric]
+        if start is not None:
+            sql += ' AND date >= ?'
+            params.append(start)
+        if end is not None:
+            sql += ' AND date <= ?'
+            params.append(end)
+        sql += ' GROUP BY date ORDER BY date'
+        return self.db.execute(sql, params).fetchall()
+
+    def importJson(self, domain, statsFile):
+        """Load an existing stats_<domain>.json file into the store,
+        returning the rollup deltas as append() does
+        """
+        with open(statsFile, 'r') as h:
+            stats = json.load(h)
+        scriptResults = {}
+        for resultDate in stats:
+            if resultDate == 'stats':
+                continue
+            for script in stats[resultDate]:
+                scriptResults.setdefault(script, {})[resultDate] = stats[resultDate][script]
+        return self.append(domain, scriptResults)
+
+class Rollup(object):
+    """Daily global totals per metric, each domain counted with its
+    latest value as of the date. The change to each total is kept per
+    date, updated from the deltas of each saved result, so a date range
+    of a metric is a single indexed range read plus the sum of the
+    changes before it.
+
+    A rollup written by an older version is stale() and has to be
+    rebuilt, a new empty one is current.
+    """
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self.db     = sqlite3.connect(dbFile, timeout=60)
+        self.db.executescript(_schema)
+        if self.version() != rollupVersion and self.db.execute('SELECT COUNT(*) FROM rollup').fetchone()[0] == 0:
+            self.setVersion()
+
+    def close(self):
+        self.db.close()
+
+    def version(self):
+        return self.db.execute('PRAGMA user_version').fetchone()[0]
+
+    def setVersion(self):
+        self.db.execute('PRAGMA user_version = %d' % rollupVersion)
+
+    def stale(self):
+        return self.version() != rollupVersion
+
+    def add(self, deltas):
+        """Apply a dict of (date, metric) -> delta"""
+        with self.db:
+            self.apply(deltas)
+
+    def apply(self, deltas):
+        for (date, metric), delta in deltas.items():
+            c = self.db.execute('UPDATE rollup SET value = value + ? WHERE metric = ? AND date = ?', (delta, metric, date))
+            if c.rowcount == 0:
+                self.db.execute('INSERT INTO rollup VALUES (?, ?, ?)', (metric, date, delta))
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM rollup')
+
+    def rebuild(self, deltas):
+        """Replace the rollup with deltas and mark it current"""
+        with self.db:
+            self.db.execute('DELETE FROM rollup')
+            self.apply(deltas)
+        self.setVersion()
+
+    def rebuildFromStats(self):
+        """Recompute the rollup from the stats table"""
+        deltas = {}
+        rows   = self.db.execute('SELECT domain, script, metric, date, value FROM stats ORDER BY domain, script, metric, date')
+        for domain, domainRows in itertools.groupby(rows, lambda row: row[0]):
+            addSeries(deltas, [row[1:] for row in domainRows])
+        self.rebuild(deltas)
+
+    def metrics(self):
+        return [row[0] for row in self.db.execute('SELECT DISTINCT metric FROM rollup ORDER BY metric')]
+
+    def series(self, metrics=None, start=None, end=None):
+        """Return { metric: [[date, total], ...] } for the date range"""
+        if not metrics:
+            metrics = self.metrics()
+        result = {}
+        for metric in metrics:
+            total = 0
+            sql    = 'SELECT date, value FROM rollup WHERE metric = ?'
+            params = [metric]
+            if start is not None:
+                total = self.db.execute('SELECT COALESCE(SUM(value), 0) FROM rollup WHERE metric = ? AND date < ?',
+                                        (metric, start)).fetchone()[0]
+                sql += ' AND date >= ?'
+                params.append(start)
+            if end is not None:
+                sql += ' AND date <= ?'
+                params.append(end)
+            sql += ' ORDER BY date'
+            result[metric] = []
+            for date, value in self.db.execute(sql, params):
+                total += value
+                result[metric].append([date, total])
+        return result
@@ -13,6 +13,7 @@ import json
 import logging
 
 from domains import Domains, Domain
+from statstore import StatStore, Rollup, useStatStore, statsDBFile, statsDeltas
 
 # import pprint
 # pp = pprint.PrettyPrinter(indent=4)
@@ -62,6 +63,205 @@ def loadConfig(configFilename):
 
     return cfg
 
+# the per-domain counts that are summed into the global stats
+countKeys = ('good_polling', 'mf_found', 'excluded', 'error_polling', 'h_card')
+
+def emptySummary():
+    return { 'domain_count':  0,
+             'start_date':    'z',
+             'end_date':      '',
+             'error_polling': 0,
+             'good_polling':  0,
+             'mf_found':      0,
+             'excluded':      0,
+             'h_card':        0,
+           }
+
+def loadLatestStats(cfg, key, statStore=None):
+    """Return (startdate, enddate, stats) for the domain where stats
+    only needs to hold the enddate, or None if it has no stats
+    """
+    if statStore is not None:
+        startdate, enddate = statStore.dateRange(key)
+        if startdate is None:
+            return None
+        return startdate, enddate, statStore.domainStats(key, start=enddate, end=enddate)
+
+    statsFile = os.path.join(cfg['domainPath'], key, 'stats_%s.json' % key)
+    if not os.path.exists(statsFile):
+        return None
+    with open(statsFile, 'r') as h:
+        stats = json.load(h)
+    keys = stats.keys()
+    if len(keys) == 0:
+        return None
+    keys.sort()
+    enddate = keys[-1]
+    if keys[-1] == 'stats':
+        enddate = keys[-2]
+    return keys[0], enddate, stats
+
+def domainContribution(cfg, key, statStore=None):
+    """Return what the domain adds to the global stats, taken from the
+    latest date in its stats, or None if it has no stats
+    """
+    latest = loadLatestStats(cfg, key, statStore)
+    if latest is None:
+        return None
+    startdate, enddate, stats = latest
+    result = { 'start_date': startdate,
+               'end_date':   enddate,
+             }
+    for k in countKeys:
+        result[k] = 0
+    if 'count_global.py' in stats[enddate]:
+        s = stats[enddate]['count_global.py']
+        for k in ('good_polling', 'mf_found', 'excluded', 'error_polling'):
+            if k in s:
+                result[k] += s[k]
+    if 'count_hcards.py' in stats[enddate]:
+        s = stats[enddate]['count_hcards.py']
+        result['h_card'] += s['h-card']
+    return result
+
+def countDate(counts, date, n):
+    counts[date] = counts.get(date, 0) + n
+    if counts[date] == 0:
+        del counts[date]
+
+def foldDomain(state, key, contribution):
+    """Replace the domain's previous contribution to the global stats in
+    state with the new one, adjusting the totals by the difference.
+
+    The number of domains starting and ending on each date is kept so
+    the date range follows from those counts, never from a rescan of
+    every domain.
+    """
+    gStats   = state['summary']
+    starts   = state.setdefault('starts', {})
+    ends     = state.setdefault('ends', {})
+    previous = state['domains'].pop(key, None)
+    if previous is not None:
+        gStats['domain_count'] -= 1
+        for k in countKeys:
+            gStats[k] -= previous[k]
+        countDate(starts, previous['start_date'], -1)
+        countDate(ends,   previous['end_date'],   -1)
+    if contribution is not None:
+        state['domains'][key] = contribution
+        gStats['domain_count'] += 1
+        for k in countKeys:
+            gStats[k] += contribution[k]
+        countDate(starts, contribution['start_date'], 1)
+        countDate(ends,   contribution['end_date'],   1)
+    gStats['start_date'] = min(starts) if starts else 'z'
+    gStats['end_date']   = max(ends)   if ends   else ''
+
+def loadState(cfg):
+    stateFile = os.path.join(cfg['dataPath'], 'summary_state.json')
+    state     = None
+    if os.path.exists(stateFile):
+        with open(stateFile, 'r') as h:
+            try:
+                state = json.load(h)
+            except:
+                log.exception('unable to read %s' % stateFile)
+    if state is not None and 'starts' not in state:
+        # written before the date counts were kept
+        state['starts'] = {}
+        state['ends']   = {}
+        for c in state['domains'].values():
+            countDate(state['starts'], c['start_date'], 1)
+            countDate(state['ends'],   c['end_date'],   1)
+    return state
+
+def saveState(cfg, state):
+    for fname, data in (('summary_state.json', state), ('summary.json', state['summary'])):
+        f       = os.path.join(cfg['dataPath'], fname)
+        tmpFile = '%s.tmp' % f
+        with open(tmpFile, 'w') as h:
+            h.write(json.dumps(data))
+        os.rename(tmpFile, f)
+
+def openStatStore(cfg):
+    if useStatStore(cfg):
+        return StatStore(statsDBFile(cfg))
+    return None
+
+def fullSummary(cfg, domains):
+    state     = { 'summary': emptySummary(),
+                  'domains': {},
+                }
+    statStore = openStatStore(cfg)
+    for key in domains:
+        foldDomain(state, key, domainContribution(cfg, key, statStore))
+    return state
+
+def rollupStale(cfg):
+    """True if the daily totals were kept by an older version"""
+    rollup = Rollup(statsDBFile(cfg))
+    try:
+        return rollup.stale()
+    finally:
+        rollup.close()
+
+def rebuildRollup(cfg, domains):
+    """Recompute the daily per-metric totals from all stats"""
+    rollup = Rollup(statsDBFile(cfg))
+    try:
+        if useStatStore(cfg):
+            rollup.rebuildFromStats()
+        else:
+            deltas = {}
+            for key in domains:
+                statsFile = os.path.join(cfg['domainPath'], key, 'stats_%s.json' % key)
+                if os.path.exists(statsFile):
+                    with open(statsFile, 'r') as h:
+                        stats = json.load(h)
+                    for (date, metric), delta in statsDeltas(stats).items():
+                        deltas[(date, metric)] = deltas.get((date, metric), 0) + delta
+            rollup.rebuild(deltas)
+    finally:
+        rollup.close()
+
+def takeChanged(cfg):
+    """Claim the list of domains cruncher has changed stats for since
+    the last summary. The claimed file is only removed by doneChanged()
+    so an interrupted run picks the same domains up again.
+    """
+    changedFile = os.path.join(cfg['dataPath'], 'changed.log')
+    workFile    = '%s.work' % changedFile
+    changed     = set()
+    if os.path.exists(changedFile):
+        if os.path.exists(workFile):
+            with open(changedFile, 'r') as h:
+                data = h.read()
+            with open(workFile, 'a') as h:
+                h.write(data)
+            os.remove(changedFile)
+        else:
+            os.rename(changedFile, workFile)
+    if os.path.exists(workFile):
+        with open(workFile, 'r') as h:
+            for line in h:
+                line = line.strip()
+                if len(line) > 0:
+                    changed.add(line)
+    return changed
+
+def doneChanged(cfg):
+    workFile = os.path.join(cfg['dataPath'], 'changed.log.work')
+    if os.path.exists(workFile):
+        os.remove(workFile)
+
+def incrementalSummary(cfg, state):
+    changed   = takeChanged(cfg)
+    statStore = openStatStore(cfg)
+    log.info('%d domains with changed stats' % len(changed))
+    for key in changed:
+        foldDomain(state, key, domainContribution(cfg, key, statStore))
+    return state
+
 
 if __name__ == '__main__':
     import argparse
@@ -69,6 +269,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config',  default='./indie-stats.cfg')
     parser.add_argument('--echo',    default=True,  action='store_true')
+    parser.add_argument('--full',    default=False, action='store_true', help='recompute the summary from every stats file')
+    parser.add_argument('--rollup',  default=False, action='store_true', help='recompute the daily totals from every stats file')
 
     args = parser.parse_args()
     cfg  = loadConfig(args.config)
@@ -77,45 +279,26 @@ if __name__ == '__main__':
 
     log.info('starting')
 
-    domains = Domains(cfg['dataPath'], cfg['domainPath'], cfg['domains'])
-    log.info('%d domains loaded from datastore' % len(domains))
-
-    gStats = { 'domain_count':  0,
-               'start_date':    'z',
-               'end_date':      '',
-               'error_polling': 0,
-               'good_polling':  0,
-               'mf_found':      0,
-               'excluded':      0,
-               'h_card':        0,
-             }
-    for key in domains:
-        domain    = domains[key]
-        statsFile = os.path.join(cfg['domainPath'], key, 'stats_%s.json' % key)
-        if os.path.exists(statsFile):
-            with open(statsFile, 'r') as h:
-                stats = json.load(h)
-
-            gStats['domain_count'] += 1
-            keys = stats.keys()
-            keys.sort()
-            if keys[0] < gStats['start_date']:
-                gStats['start_date'] = keys[0]
-            enddate = keys[-1]
-            if keys[-1] == 'stats':
-                enddate = keys[-2]
-            if enddate > gStats['end_date']:
-                gStats['end_date'] = enddate
-
-            if 'count_global.py' in stats[enddate]:
-                s = stats[enddate]['count_global.py']
-                for k in ('good_polling', 'mf_found', 'excluded', 'error_polling'):
-                    if k in s:
-                        gStats[k] += s[k]
-            if 'count_hcards.py' in stats[enddate]:
-                s = stats[enddate]['count_hcards.py']
-                gStats['h_card'] += s['h-card']
-
-    f = os.path.join(cfg['dataPath'], 'summary.json')
-    with open(f, 'w') as h:
-        h.write(json.dumps(gStats))
+    state   = None
+    domains = None
+    if not args.full:
+        state = loadState(cfg)
+
+    rollup = args.rollup or rollupStale(cfg)
+    if state is None or rollup:
+        domains = Domains(cfg['dataPath'], cfg['domainPath'], cfg['domains'])
+        log.info('%d domains loaded from datastore' % len(domains))
+
+    if rollup:
+        log.info('rebuilding the daily totals')
+        rebuildRollup(cfg, domains)
+
+    if state is None:
+        # stats from the changed list are included in a full summary
+        takeChanged(cfg)
+        state = fullSummary(cfg, domains)
+    else:
+        state = incrementalSummary(cfg, state)
+
+    saveState(cfg, state)
+    doneChanged(cfg)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Check that fetcher.readPage gives up on a slow-drip page at the
+deadline, against a real local HTTP server.
+"""
+
+import os, sys
+import time
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fetcher
+
+
+dripBytes    = 40
+dripInterval = 0.5
+
+class DripHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(dripBytes))
+        self.end_headers()
+        try:
+            for i in range(dripBytes):
+                if self.server.stopped.is_set():
+                    break
+                self.wfile.write('x')
+                self.wfile.flush()
+                time.sleep(dripInterval)
+        except Exception:
+            pass  # the client gave up
+
+    def log_message(self, *args):
+        pass
+
+class KeepAliveDripHandler(DripHandler):
+    protocol_version = 'HTTP/1.1'
+
+class QuietServer(BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, clientAddress):
+        pass  # the client hanging up mid drip is the point of the test
+
+class DeadlineTest(unittest.TestCase):
+    deadline = 2
+
+    def serve(self, handler):
+        server = QuietServer(('127.0.0.1', 0), handler)
+        server.stopped = threading.Event()
+        t      = threading.Thread(target=server.handle_request)
+        t.daemon = True
+        t.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(t.join)
+        self.addCleanup(server.stopped.set)
+        return 'http://127.0.0.1:%d/' % server.server_port
+
+    def fetch(self, url):
+        options = fetcher.sessionOptions({ 'http': { 'deadline': self.deadline }})
+        session = fetcher.buildSession(options)
+        started = time.time()
+        r       = session.get(url, timeout=(5, 30), stream=True)
+        try:
+            with self.assertRaises(fetcher.FetchLimit) as cm:
+                fetcher.readPage(r, options, started)
+        finally:
+            r.close()
+        return cm.exception, time.time() - started
+
+    def checkAborted(self, handler):
+        e, elapsed = self.fetch(self.serve(handler))
+        self.assertEqual(e.status, fetcher.abortedStatus)
+        self.assertLess(elapsed, self.deadline + 1)
+
+    def test_http10(self):
+        # the server closes the connection after the response
+        self.checkAborted(DripHandler)
+
+    def test_keepalive(self):
+        self.checkAborted(KeepAliveDripHandler)
+
+
+if __name__ == '__main__':
+    unittest.main()
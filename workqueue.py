@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+:copyright: (c) 2014-2015 by Mike Taylor
+:license: MIT, see LICENSE for more details.
+
+Redis backed work queue of domains that any number of crawler or
+cruncher processes, on any number of hosts, can drain together.
+"""
+
+import time
+import logging
+import threading
+
+from schedule import toTimestamp, fromTimestamp
+
+log = logging.getLogger('workqueue')
+
+# list of domains still to be handed out, sorted set of
+# domain -> lease expiry for the ones handed out and not yet
+# completed, and the marker for the run in progress
+queueKey = 'queue-%s'
+leaseKey = 'queue-%s-leases'
+runKey   = 'queue-%s-run'
+
+# expired leases go back on the end of the queue before the next
+# domain is taken so a domain held by a worker that died is retried
+_claimLua = """
+local now     = tonumber(ARGV[1])
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for i, name in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], name)
+    redis.call('RPUSH', KEYS[1], name)
+end
+local name = redis.call('LPOP', KEYS[1])
+if name then
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), name)
+end
+return name
+"""
+
+# a stale run is only replaced by the one process that still finds
+# the marker it read
+_replaceLua = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], 'filling', 'EX', tonumber(ARGV[2]))
+    return 1
+end
+return 0
+"""
+
+def queueOptions(cfg):
+    """Return the lease settings, using any values found in the
+    'queue' config block
+    """
+    options = { 'lease':        600,
+                'fill_timeout': 300,
+                'run_timeout':  20 * 3600,
+              }
+    if 'queue' in cfg:
+        options.update(cfg['queue'])
+    return options
+
+class WorkQueue(object):
+    """A run's worth of domains kept in Redis. Each domain is leased
+    to one worker at a time and only leaves the queue once the worker
+    completes it, so a run that is killed partway resumes from the
+    domains that were not finished the next time it is started.
+
+    A run started more than runTimeout seconds ago is left by a process
+    that crashed or was killed, the next start() replaces it with a new
+    run rather than keep joining it. Its unfinished domains are still
+    due or pending so they are in the new run.
+
+    Lease and run expiry use the local clock, hosts draining the same
+    queue need to keep their clocks in sync.
+    """
+    def __init__(self, db, name, lease=600, fillTimeout=300, runTimeout=20 * 3600):
+        self.db            = db
+        self.name          = name
+        self.lease         = lease
+        self.fillTimeout   = fillTimeout
+        self.runTimeout    = runTimeout
+        self.queueKey      = queueKey % name
+        self.leaseKey      = leaseKey % name
+        self.runKey        = runKey   % name
+        self.claimScript   = db.register_script(_claimLua)
+        self.replaceScript = db.register_script(_replaceLua)
+
+    def start(self, getKeys):
+        """Join the current run or, if there isn't one or it is stale,
+        start a new run with the domains returned by getKeys(). Returns
+        True if a new run was started.
+
+        Workers that join while the queue is being filled wait for it.
+        The fill marker is kept alive for as long as getKeys() runs, it
+        only expires fillTimeout seconds after the filler has died.
+        """
+        if self.takeRun():
+            filled    = threading.Event()
+            keepAlive = threading.Thread(target=self.keepFilling, args=(filled,))
+            keepAlive.daemon = True
+            keepAlive.start()
+            try:
+                pipe = self.db.pipeline()
+                pipe.delete(self.queueKey, self.leaseKey)
+                n    = 0
+                for key in getKeys():
+                    pipe.rpush(self.queueKey, key)
+                    n += 1
+                    if n % 1000 == 0:
+                        pipe.execute()
+                pipe.execute()
+            finally:
+                filled.set()
+                keepAlive.join()
+            # set after the keep alive has stopped so the run marker
+            # is never given an expiry
+            self.db.set(self.runKey, fromTimestamp(time.time()))
+            log.info('%s: new run of %d domains' % (self.name, n))
+            return True
+
+        while self.db.get(self.runKey) == 'filling':
+            time.sleep(1)
+        log.info('%s: joining run with %d domains left' % (self.name, self.remaining()))
+        return False
+
+    def takeRun(self):
+        """Set the fill marker if there is no run or the current one is
+        stale. Returns True if this process is to fill a new run.
+        """
+        if self.db.set(self.runKey, 'filling', nx=True, ex=self.fillTimeout):
+            return True
+        started = self.db.get(self.runKey)
+        if started is None:
+            # ended since the marker was set
+            return self.takeRun()
+        if started == 'filling' or toTimestamp(started) > time.time() - self.runTimeout:
+            return False
+        if self.replaceScript(keys=[self.runKey], args=[started, self.fillTimeout]):
+            log.warning('%s: replacing the run started at %s with %d domains left' % (self.name, started, self.remaining()))
+            return True
+        return False
+
+    def keepFilling(self, filled):
+        while not filled.wait(self.fillTimeout / 3.0):
+            self.db.expire(self.runKey, self.fillTimeout)
+
+    def claim(self):
+        """Lease the next domain, returning None once the queue is empty"""
+        return self.claimScript(keys=[self.queueKey, self.leaseKey], args=[time.time(), self.lease])
+
+    def complete(self, key):
+        self.db.zrem(self.leaseKey, key)
+
+    def remaining(self):
+        pipe = self.db.pipeline()
+        pipe.llen(self.queueKey)
+        pipe.zcard(self.leaseKey)
+        waiting, leased = pipe.execute()
+        return waiting + leased
+
+    def finish(self):
+        """End the run if every domain has been completed so the next
+        start() begins a new one. Returns True if the run was ended.
+        """
+        if self.remaining() == 0:
+            self.db.delete(self.runKey, self.queueKey, self.leaseKey)
+            log.info('%s: run completed' % self.name)
+            return True
+        return False
+
+def openQueue(cfg, db, name):
+    options = queueOptions(cfg)
+    return WorkQueue(db, name, options['lease'], options['fill_timeout'], options['run_timeout'])